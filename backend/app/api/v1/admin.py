@@ -4,6 +4,7 @@ from fastapi import APIRouter, Depends, HTTPException, status
 
 from app.dependencies import get_admin_user
 from app.models.tortoise.user import User
+from app.services.redis_service import redis_service
 from app.services.task_service import task_service
 
 router = APIRouter()
@@ -25,4 +26,4 @@ async def parse_stores(current_user: User = Depends(get_admin_user)):
 @router.get("/stats")
 async def get_stats(current_user: User = Depends(get_admin_user)):
     """Получить статистику (только админ)"""
-    return {"status": "success", "message": "Stats will be here soon"}
+    return {"status": "success", "cache": redis_service.get_stats()}
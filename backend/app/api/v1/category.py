@@ -1,9 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, status
 
 from app.dependencies import get_admin_user, get_current_user
 from app.models.tortoise.user import User
 from app.schemas.category import CategoryCreate, CategoryResponse, ListCategoryResponse
 from app.services.category_service import CategoryService
+from app.utils.etag import json_response
 
 router = APIRouter()
 service = CategoryService()
@@ -13,9 +16,15 @@ service = CategoryService()
     "",
     response_model=ListCategoryResponse,
 )
-async def get_all_categories():
+async def get_all_categories(
+    if_none_match: Optional[str] = Header(None),
+):
     categories = await service.get_all_categories()
-    return {"items": categories, "total": len(categories)}
+    # ETag - хэш самого ответа: он верен и после записей в обход сервиса
+    body = ListCategoryResponse(
+        items=categories, total=len(categories)
+    ).model_dump_json().encode()
+    return json_response(body, if_none_match)
 
 
 @router.post(
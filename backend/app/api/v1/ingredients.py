@@ -1,12 +1,14 @@
 from typing import List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Query, status
+import orjson
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, status
 
 from app.dependencies import get_admin_user, get_current_user
 from app.models.tortoise.user import User
 from app.schemas.ingredient import IngredientCreate, IngredientResponse
 from app.schemas.substitute import SubstituteCreate, SubstituteResponse
 from app.services.ingredient_service import IngredientService
+from app.utils.etag import json_response
 
 router = APIRouter(tags=["ingredients"])
 ingredient_service = IngredientService()
@@ -16,12 +18,15 @@ ingredient_service = IngredientService()
 async def get_ingredients(
     cursor: Optional[str] = Query(None),
     size: int = Query(50, le=200),
+    if_none_match: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user),
 ):
     """
     Получить список всех ингредиентов с пагинацией
     """
-    return await ingredient_service.get_all_ingredients(size=size, cursor=cursor)
+    page = await ingredient_service.get_all_ingredients(size=size, cursor=cursor)
+    # ETag - хэш самой страницы: он верен и после записей в обход сервиса
+    return json_response(orjson.dumps(page), if_none_match)
 
 
 
@@ -105,10 +110,14 @@ async def get_substitutes(
     return await ingredient_service.get_substitutes(ingredient_id)
 
 
-@router.get("/substitutes/all", response_model=List[SubstituteResponse])
-async def get_all_substitutes(current_user: User = Depends(get_current_user)):
-    """Получить все замены ингредиентов"""
-    return await ingredient_service.get_all_substitutes()
+@router.get("/substitutes/all", response_model=dict)
+async def get_all_substitutes(
+    cursor: Optional[str] = Query(None),
+    size: int = Query(50, le=200),
+    current_user: User = Depends(get_current_user),
+):
+    """Получить все замены ингредиентов с пагинацией"""
+    return await ingredient_service.get_all_substitutes(size=size, cursor=cursor)
 
 
 @router.post("/substitutes", response_model=SubstituteResponse)
@@ -1,15 +1,55 @@
-from typing import List, Optional
+from typing import List, Literal, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    status,
+)
+
+from fastapi.responses import StreamingResponse
 
 from app.dependencies import get_admin_user, get_current_user
 from app.models.tortoise.user import User
-from app.schemas.recipe import RecipeCreate, RecipeResponse
+from app.schemas.recipe import (
+    RecipeBatchRequest,
+    RecipeCreate,
+    RecipeResponse,
+    RecipeUpdate,
+)
 from app.services.recipe_service import RecipeService
+from app.utils.etag import json_response
 
 router = APIRouter(tags=["recipes"])
 recipe_service = RecipeService()
 
+MAX_BATCH_IDS = 100
+
+
+def _parse_ids(value: Optional[str], param: str) -> Optional[List[int]]:
+    """ID через запятую -> список int"""
+    if not value:
+        return None
+    try:
+        return [int(x) for x in value.split(",")]
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid {param} format",
+        )
+
+
+def _check_ingredients_count(ingredients: list):
+    if len(ingredients) < 2 or len(ingredients) > 30:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Recipe must have between 2 and 30 ingredients",
+        )
+
 
 @router.get("", response_model=dict)
 async def get_recipes(
@@ -20,6 +60,10 @@ async def get_recipes(
     max_calories: Optional[float] = None,
     max_time: Optional[int] = None,
     exclude_ingredients: Optional[str] = Query(None),
+    include_ingredients: Optional[str] = Query(None),
+    include_mode: Literal["all", "any"] = Query("all"),
+    fields: Optional[str] = Query(None),
+    if_none_match: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user),
 ):
     """
@@ -33,39 +77,136 @@ async def get_recipes(
     - max_calories: максимальные калории (опционально)
     - max_time: максимальное время приготовления в минутах (опционально)
     - exclude_ingredients: ID ингредиентов для исключения через запятую (опционально)
+    - include_ingredients: ID ингредиентов, которые должны быть в рецепте, через запятую (опционально)
+    - include_mode: all - все include_ingredients, any - хотя бы один (по умолчанию all)
+    - fields: поля рецептов через запятую (опционально, по умолчанию краткая карточка:
+      название, описание, категория, время, сложность, порции и КБЖУ на порцию)
     """
-    exclude_list = None
-    if exclude_ingredients:
-        try:
-            exclude_list = [int(x) for x in exclude_ingredients.split(",")]
-        except:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid exclude_ingredients format",
-            )
-
-    return await recipe_service.get_recipes(
+    body = await recipe_service.get_recipes(
         cursor=cursor,
         size=size,
         category_id=category_id,
         min_calories=min_calories,
         max_calories=max_calories,
         max_time=max_time,
-        exclude_ingredients=exclude_list,
+        exclude_ingredients=_parse_ids(exclude_ingredients, "exclude_ingredients"),
+        include_ingredients=_parse_ids(include_ingredients, "include_ingredients"),
+        include_mode=include_mode,
+        fields=[field.strip() for field in fields.split(",")] if fields else None,
+        as_json=True,
     )
+    return json_response(body, if_none_match)
+
+
+@router.get("/pantry", response_model=dict)
+async def match_pantry(
+    ingredients: str = Query(...),
+    use_substitutes: bool = False,
+    min_coverage: float = Query(0.0, ge=0, le=1),
+    cursor: Optional[str] = Query(None),
+    size: int = Query(30, le=50),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Что приготовить: рецепты по доле ингредиентов, которые есть у пользователя
+
+    query параметры:
+    - ingredients: ID имеющихся ингредиентов через запятую
+    - use_substitutes: засчитывать ингредиенты, для которых есть замена из имеющихся
+    - min_coverage: минимальная доля имеющихся ингредиентов рецепта (0..1)
+    - cursor: курсор для следующей страницы (опционально)
+    - size: количество рецептов на странице (по умолчанию 30, максимум 50)
+    """
+    ingredient_ids = _parse_ids(ingredients, "ingredients")
+    if not ingredient_ids:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="At least one ingredient is required",
+        )
+
+    return await recipe_service.match_pantry(
+        ingredient_ids=ingredient_ids,
+        use_substitutes=use_substitutes,
+        min_coverage=min_coverage,
+        cursor=cursor,
+        size=size,
+    )
+
+
+@router.get("/export")
+async def export_recipes(
+    category_id: Optional[int] = None,
+    min_calories: Optional[float] = None,
+    max_calories: Optional[float] = None,
+    max_time: Optional[int] = None,
+    exclude_ingredients: Optional[str] = Query(None),
+    include_ingredients: Optional[str] = Query(None),
+    include_mode: Literal["all", "any"] = Query("all"),
+    gzip: bool = False,
+    current_user: User = Depends(get_admin_user),
+):
+    """
+    Выгрузить рецепты в NDJSON - по рецепту в строке (только админ)
+
+    query параметры: фильтры как у GET /recipes (без cursor и size) и
+    - gzip: сжать выгрузку (файл recipes.ndjson.gz)
+    """
+    chunks = recipe_service.export_recipes(
+        category_id=category_id,
+        min_calories=min_calories,
+        max_calories=max_calories,
+        max_time=max_time,
+        exclude_ingredients=_parse_ids(exclude_ingredients, "exclude_ingredients"),
+        include_ingredients=_parse_ids(include_ingredients, "include_ingredients"),
+        include_mode=include_mode,
+        compress=gzip,
+    )
+    filename = "recipes.ndjson.gz" if gzip else "recipes.ndjson"
+    return StreamingResponse(
+        chunks,
+        media_type="application/gzip" if gzip else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@router.post("/batch", response_model=dict)
+async def get_recipes_batch(
+    request: RecipeBatchRequest, current_user: User = Depends(get_current_user)
+):
+    """
+    Получить несколько рецептов по списку ID (избранное, план питания)
+
+    body: {"ids": ["...", "..."]} - не больше 100 ID
+
+    Ответ: {"data": [рецепты в порядке ids], "not_found": [ненайденные ID]}
+    """
+    if len(request.ids) > MAX_BATCH_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"No more than {MAX_BATCH_IDS} ids per request",
+        )
+
+    body = await recipe_service.get_recipes_by_ids(request.ids, as_json=True)
+    return Response(content=body, media_type="application/json")
 
 
 @router.get("/{recipe_id}", response_model=RecipeResponse)
-async def get_recipe(recipe_id: str, current_user: User = Depends(get_current_user)):
+async def get_recipe(
+    recipe_id: str,
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+):
     """Получить рецепт по ID"""
-    recipe = await recipe_service.get_recipe(recipe_id)
+    body = await recipe_service.get_recipe(recipe_id, as_json=True)
 
-    if not recipe:
+    if not body:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Recipe not found"
         )
 
-    return recipe
+    # Тело ответа уже провалидировано и сериализовано при записи в кэш,
+    # ETag считается по нему же - без обращения к MongoDB
+    return json_response(body, if_none_match)
 
 
 @router.post("", response_model=RecipeResponse)
@@ -73,11 +214,7 @@ async def create_recipe(
     recipe: RecipeCreate, current_user: User = Depends(get_admin_user)
 ):
     """Создать новый рецепт (только администратор)"""
-    if len(recipe.ingredients) < 2 or len(recipe.ingredients) > 30:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Recipe must have between 2 and 30 ingredients",
-        )
+    _check_ingredients_count(recipe.ingredients)
 
     recipe_data = recipe.dict()
     created_recipe = await recipe_service.create_recipe(recipe_data)
@@ -85,20 +222,60 @@ async def create_recipe(
     return created_recipe
 
 
+@router.post("/import", response_model=dict)
+async def import_recipes(request: Request, current_user: User = Depends(get_admin_user)):
+    """
+    Массовый импорт рецептов (только админ)
+
+    body: NDJSON - по одному рецепту (как в POST /recipes) в строке.
+    Тело читается потоком, рецепты пишутся пачками.
+
+    Ответ: {"inserted": 199990, "failed": 10, "errors": [{"line": 17, "error": "..."}]}
+    """
+    return await recipe_service.import_recipes(request.stream())
+
+
 @router.put("/{recipe_id}", response_model=RecipeResponse)
 async def update_recipe(
     recipe_id: str, recipe: RecipeCreate, current_user: User = Depends(get_admin_user)
 ):
     """Обновить рецепт (только админ)"""
-    existing_recipe = await recipe_service.get_recipe(recipe_id)
+    _check_ingredients_count(recipe.ingredients)
+
+    updated_recipe = await recipe_service.update_recipe(recipe_id, recipe.dict())
 
-    if not existing_recipe:
+    if not updated_recipe:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Recipe not found"
         )
 
-    recipe_data = recipe.dict()
-    updated_recipe = await recipe_service.update_recipe(recipe_id, recipe_data)
+    return updated_recipe
+
+
+@router.patch("/{recipe_id}", response_model=RecipeResponse)
+async def patch_recipe(
+    recipe_id: str, recipe: RecipeUpdate, current_user: User = Depends(get_admin_user)
+):
+    """
+    Частично обновить рецепт (только админ)
+
+    Передаются только изменяемые поля; КБЖУ пересчитывается, если среди
+    них есть ingredients или portions
+    """
+    changes = {
+        field: value
+        for field, value in recipe.dict(include=recipe.model_fields_set).items()
+        if value is not None
+    }
+    if "ingredients" in changes:
+        _check_ingredients_count(changes["ingredients"])
+
+    updated_recipe = await recipe_service.update_recipe(recipe_id, changes)
+
+    if not updated_recipe:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Recipe not found"
+        )
 
     return updated_recipe
 
@@ -120,11 +297,18 @@ async def delete_recipe(recipe_id: str, current_user: User = Depends(get_admin_u
 async def get_recipe_with_substitutes(
     recipe_id: str,
     unavailable_ingredients: List[dict],
+    preference: Literal[
+        "closest", "low_calorie", "high_protein", "low_fat", "low_carb"
+    ] = Query("closest"),
     current_user: User = Depends(get_current_user),
 ):
     """
     Получить рецепт с заменами ингредиентов
 
+    query параметры:
+    - preference: как выбирать замену - closest (ближе всего по БЖУ к оригиналу),
+      low_calorie, high_protein, low_fat, low_carb (по умолчанию closest)
+
     body: {
         "unavailable_ingredients": [
             {"ingredient_id": 1},
@@ -132,14 +316,17 @@ async def get_recipe_with_substitutes(
         ]
     }
     """
-    recipe = await recipe_service.get_recipe_with_substitutes(
-        recipe_id=recipe_id, unavailable_ingredients=unavailable_ingredients
+    body = await recipe_service.get_recipe_with_substitutes(
+        recipe_id=recipe_id,
+        unavailable_ingredients=unavailable_ingredients,
+        preference=preference,
+        as_json=True,
     )
 
-    if not recipe:
+    if not body:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Recipe not found or cannot be made with substitutes",
         )
 
-    return recipe
+    return Response(content=body, media_type="application/json")
@@ -0,0 +1,99 @@
+from typing import Dict, List
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, IndexModel
+
+# Декларативный реестр индексов MongoDB: коллекция -> индексы.
+# Составные индексы повторяют формы запросов get_recipes (фильтр + сортировка по _id).
+INDEXES: Dict[str, List[IndexModel]] = {
+    "recipes": [
+        IndexModel(
+            [("category_id", ASCENDING), ("_id", ASCENDING)],
+            name="category_id_id",
+        ),
+        IndexModel(
+            [
+                ("category_id", ASCENDING),
+                ("total_calories", ASCENDING),
+                ("_id", ASCENDING),
+            ],
+            name="category_id_total_calories_id",
+        ),
+        IndexModel(
+            [("total_calories", ASCENDING), ("_id", ASCENDING)],
+            name="total_calories_id",
+        ),
+        IndexModel(
+            [("cook_time_minutes", ASCENDING), ("_id", ASCENDING)],
+            name="cook_time_minutes_id",
+        ),
+        # Multikey индекс по денормализованному массиву ID ингредиентов:
+        # фильтры exclude/include_ingredients и поиск рецептов по ингредиенту
+        IndexModel(
+            [("ingredient_ids", ASCENDING), ("_id", ASCENDING)],
+            name="ingredient_ids_id",
+        ),
+    ],
+    "store_products": [
+        IndexModel([("ingredient_id", ASCENDING)], name="ingredient_id"),
+    ],
+}
+
+
+async def diff_indexes(db: AsyncIOMotorDatabase) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Сравнить реестр с индексами в базе: missing / changed / extra по коллекциям
+    """
+    result = {}
+    for collection_name, models in INDEXES.items():
+        existing = await db[collection_name].index_information()
+        existing.pop("_id_", None)
+
+        missing, changed = [], []
+        for model in models:
+            spec = model.document
+            current = existing.pop(spec["name"], None)
+            if current is None:
+                missing.append(spec["name"])
+            elif list(current["key"]) != list(spec["key"].items()):
+                changed.append(spec["name"])
+
+        result[collection_name] = {
+            "missing": missing,
+            "changed": changed,
+            "extra": sorted(existing),
+        }
+    return result
+
+
+async def apply_indexes(
+    db: AsyncIOMotorDatabase, drop_extra: bool = False
+) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Привести индексы к реестру: создать недостающие, пересоздать изменённые
+    """
+    diff = await diff_indexes(db)
+    for collection_name, models in INDEXES.items():
+        collection = db[collection_name]
+        collection_diff = diff[collection_name]
+
+        for name in collection_diff["changed"]:
+            await collection.drop_index(name)
+        if drop_extra:
+            for name in collection_diff["extra"]:
+                await collection.drop_index(name)
+
+        to_create = set(collection_diff["missing"]) | set(collection_diff["changed"])
+        models_to_create = [m for m in models if m.document["name"] in to_create]
+        if models_to_create:
+            await collection.create_indexes(models_to_create)
+    return diff
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase):
+    """
+    Создать индексы из реестра (идемпотентно, вызывается при старте)
+    """
+    for collection_name, models in INDEXES.items():
+        await db[collection_name].create_indexes(models)
+    print("✅ MongoDB indexes ensured")
@@ -5,18 +5,33 @@ from fastapi.middleware.cors import CORSMiddleware
 from tortoise.contrib.fastapi import register_tortoise
 
 from app.api.v1 import admin, auth, category, ingredients, recipes, store
-from app.db.mongodb import close_mongodb, init_mongodb
+from app.db.indexes import ensure_indexes
+from app.db.mongodb import close_mongodb, get_mongodb, init_mongodb
 from app.db.tortoise_config import TORTOISE_ORM, close_tortoise, init_tortoise
+from app.services.ingredient_catalog import ingredient_catalog
+from app.services.pantry_index import pantry_index
+from app.services.redis_service import redis_service
+from app.services.substitute_index import substitute_index
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_tortoise()
     await init_mongodb()
+    await ensure_indexes(await get_mongodb())
     print("✅ Databases initialized")
 
+    await redis_service.start_invalidation_listener()
+    await ingredient_catalog.start()
+    await substitute_index.start()
+    await pantry_index.start()
+
     yield
 
+    await pantry_index.stop()
+    await substitute_index.stop()
+    await ingredient_catalog.stop()
+    await redis_service.stop_invalidation_listener()
     await close_tortoise()
     await close_mongodb()
     print("❌ Databases closed")
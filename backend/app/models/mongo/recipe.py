@@ -49,6 +49,7 @@ class Recipe(BaseModel):
     difficulty: str = "easy"
     ingredients: List[RecipeIngredient]
     instructions: List[RecipeInstruction]
+    ingredient_ids: List[int] = []
     total_calories: float
     total_protein: float
     total_fat: float
@@ -1,7 +1,7 @@
 from datetime import datetime
 from typing import List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class RecipeIngredientCreate(BaseModel):
@@ -37,12 +37,27 @@ class RecipeCreate(BaseModel):
     description: str
     category_id: int
     cook_time_minutes: int
-    portions: int
+    portions: int = Field(gt=0)
     difficulty: str = "easy"
     ingredients: List[RecipeIngredientCreate]
     instructions: List[RecipeInstructionCreate]
 
 
+class RecipeUpdate(BaseModel):
+    name: Optional[str] = None
+    description: Optional[str] = None
+    category_id: Optional[int] = None
+    cook_time_minutes: Optional[int] = None
+    portions: Optional[int] = Field(None, gt=0)
+    difficulty: Optional[str] = None
+    ingredients: Optional[List[RecipeIngredientCreate]] = None
+    instructions: Optional[List[RecipeInstructionCreate]] = None
+
+
+class RecipeBatchRequest(BaseModel):
+    ids: List[str]
+
+
 class RecipeResponse(BaseModel):
     id: str
     name: str
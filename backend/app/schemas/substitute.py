@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import Optional
 
 from pydantic import BaseModel, Field
 
@@ -13,6 +14,7 @@ class SubstituteResponse(BaseModel):
     id: int
     original_ingredient_id: int
     substitute_ingredient_id: int
+    substitute_name: Optional[str] = None
     coefficient: float
     created_at: datetime
 
@@ -0,0 +1,127 @@
+import asyncio
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Mapping, Optional
+
+from app.config import settings
+from app.models.tortoise.ingredient import Ingredient
+from app.services.redis_service import redis_service
+
+CATALOG_NAMESPACE = "ingredients"
+
+CATALOG_FIELDS = (
+    "id",
+    "name",
+    "calories_per_100g",
+    "protein_per_100g",
+    "fat_per_100g",
+    "carbs_per_100g",
+    "created_at",
+)
+
+
+class IngredientCatalog:
+    """
+    Неизменяемый снимок справочника ингредиентов в памяти процесса.
+
+    Снимок целиком заменяется при перезагрузке, версия хранится в Redis:
+    любой воркер, изменивший ингредиенты, увеличивает её и сразу перечитывает
+    свой снимок, а остальные замечают это в фоновом цикле.
+
+    Перезагрузки выполняются под блокировкой: снимок, прочитанный из базы
+    раньше, не может заменить прочитанный позже.
+    """
+
+    def __init__(self) -> None:
+        self._snapshot: Mapping[int, Mapping[str, Any]] = MappingProxyType({})
+        self._version: Optional[int] = None
+        self._loaded = False
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._loaded
+
+    @property
+    def version(self) -> Optional[int]:
+        return self._version
+
+    def get(self, ingredient_id: int) -> Optional[Dict[str, Any]]:
+        ingredient = self._snapshot.get(ingredient_id)
+        return dict(ingredient) if ingredient is not None else None
+
+    def get_many(self, ingredient_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        snapshot = self._snapshot
+        return {
+            ingredient_id: dict(snapshot[ingredient_id])
+            for ingredient_id in ingredient_ids
+            if ingredient_id in snapshot
+        }
+
+    async def _fetch_version(self) -> int:
+        return await redis_service.get_namespace_version(
+            CATALOG_NAMESPACE, local=False
+        )
+
+    async def load(self, version: Optional[int] = None):
+        """
+        Перечитать все ингредиенты одним запросом и подменить снимок
+        """
+        async with self._lock:
+            # Версию берём до запроса: снимок никогда не окажется старее неё
+            if version is None:
+                version = await self._fetch_version()
+
+            rows = await Ingredient.all().values(*CATALOG_FIELDS)
+            self._snapshot = MappingProxyType(
+                {row["id"]: MappingProxyType(row) for row in rows}
+            )
+            self._version = version
+            self._loaded = True
+
+    async def ensure_loaded(self):
+        if not self._loaded:
+            await self.load()
+
+    async def invalidate(self):
+        """
+        Увеличить версию справочника после изменения ингредиентов и сразу
+        перечитать снимок, чтобы этот процесс не отдал старые данные
+        """
+        version = await redis_service.bump_namespace(CATALOG_NAMESPACE)
+        await self.load(version)
+
+    async def refresh(self):
+        """
+        Перечитать снимок, если другой воркер увеличил версию
+        """
+        version = await self._fetch_version()
+        if version != self._version:
+            await self.load()
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(settings.INGREDIENT_CATALOG_REFRESH_SECONDS)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Ingredient catalog refresh failed: {e}")
+
+    async def start(self):
+        await self.load()
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+        print(f"✅ Ingredient catalog loaded - {len(self._snapshot)} ingredients")
+
+    async def stop(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+
+
+ingredient_catalog = IngredientCatalog()
@@ -1,10 +1,47 @@
-from typing import Any, Dict, List, Optional
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Set
 
 from fastapi import HTTPException, status
 from tortoise.exceptions import DoesNotExist
 
 from app.models.tortoise.ingredient import Ingredient
 from app.models.tortoise.substitute import Substitute
+from app.services.ingredient_catalog import ingredient_catalog
+from app.services.redis_service import redis_service
+from app.services.substitute_index import (
+    MACRO_FIELDS,
+    SUBSTITUTES_NAMESPACE,
+    substitute_index,
+)
+from app.services.task_service import task_service
+
+logger = logging.getLogger(__name__)
+
+# ID ингредиентов, пересчёт КБЖУ рецептов которых не удалось поставить в очередь
+NUTRITION_PENDING_KEY = "nutrition:pending_recalculation"
+
+
+def _ingredient_to_dict(ingredient: Ingredient) -> Dict[str, Any]:
+    return {
+        "id": ingredient.id,
+        "name": ingredient.name,
+        "calories_per_100g": ingredient.calories_per_100g,
+        "protein_per_100g": ingredient.protein_per_100g,
+        "fat_per_100g": ingredient.fat_per_100g,
+        "carbs_per_100g": ingredient.carbs_per_100g,
+        "created_at": ingredient.created_at,
+    }
+
+
+def _substitute_to_dict(substitute: Substitute) -> Dict[str, Any]:
+    return {
+        "id": substitute.id,
+        "original_ingredient_id": substitute.original_ingredient_id,
+        "substitute_ingredient_id": substitute.substitute_ingredient_id,
+        "substitute_name": substitute.substitute_ingredient.name,
+        "coefficient": substitute.coefficient,
+        "created_at": substitute.created_at,
+    }
 
 
 class IngredientService:
@@ -12,21 +49,35 @@ class IngredientService:
         """
         Получить ингредиент по ID
         """
+        cached = ingredient_catalog.get(ingredient_id)
+        if cached is not None:
+            return cached
+
         try:
             ingredient = await Ingredient.get(id=ingredient_id)
-
-            return {
-                "id": ingredient.id,
-                "name": ingredient.name,
-                "calories_per_100g": ingredient.calories_per_100g,
-                "protein_per_100g": ingredient.protein_per_100g,
-                "fat_per_100g": ingredient.fat_per_100g,
-                "carbs_per_100g": ingredient.carbs_per_100g,
-                "created_at": ingredient.created_at,
-            }
+            return _ingredient_to_dict(ingredient)
         except DoesNotExist:
             return None
 
+    async def get_ingredients_by_ids(
+        self, ingredient_ids: Iterable[int]
+    ) -> Dict[int, Dict[str, Any]]:
+        """
+        Получить ингредиенты по списку ID одним запросом (ключ словаря - ID)
+        """
+        ids = set(ingredient_ids)
+        if not ids:
+            return {}
+
+        result = ingredient_catalog.get_many(ids)
+        missing_ids = ids - result.keys()
+        if missing_ids:
+            # Ингредиент мог появиться в другом воркере до обновления снимка
+            ingredients = await Ingredient.filter(id__in=missing_ids)
+            result.update({ing.id: _ingredient_to_dict(ing) for ing in ingredients})
+
+        return result
+
     async def get_all_ingredients(
         self, size: int = 50, cursor: Optional[str] = None
     ) -> dict:
@@ -50,22 +101,8 @@ class IngredientService:
             next_cursor = str(ingredients[-1].id)
             ingredients = ingredients[:-1]
 
-        data = []
-        for ing in ingredients:
-            data.append(
-                {
-                    "id": ing.id,
-                    "name": ing.name,
-                    "calories_per_100g": ing.calories_per_100g,
-                    "protein_per_100g": ing.protein_per_100g,
-                    "fat_per_100g": ing.fat_per_100g,
-                    "carbs_per_100g": ing.carbs_per_100g,
-                    "created_at": ing.created_at,
-                }
-            )
-
         return {
-            "data": data,
+            "data": [_ingredient_to_dict(ing) for ing in ingredients],
             "next_cursor": next_cursor,
             "has_more": has_more,
         }
@@ -84,6 +121,7 @@ class IngredientService:
             )
 
         ingredient = await Ingredient.create(**ingredient_data)
+        await ingredient_catalog.invalidate()
         return ingredient
 
     async def update_ingredient(
@@ -104,12 +142,57 @@ class IngredientService:
                         detail=f"Ingredient with name '{name}' already exists",
                     )
 
+            macros_changed = any(
+                getattr(ingredient, field) != ingredient_data[field]
+                for field in MACRO_FIELDS
+                if field in ingredient_data
+            )
+
             await ingredient.update_from_dict(ingredient_data)
             await ingredient.save()
+            await ingredient_catalog.invalidate()
+            await substitute_index.refresh()
+
+            # КБЖУ рецептов с этим ингредиентом пересчитывает воркер
+            await self._enqueue_nutrition_recalculation(ingredient_id, macros_changed)
+
             return ingredient
         except DoesNotExist:
             return None
 
+    async def _enqueue_nutrition_recalculation(
+        self, ingredient_id: int, macros_changed: bool
+    ):
+        """
+        Поставить пересчёт КБЖУ рецептов в очередь. Если очередь недоступна,
+        ингредиент помечается в Redis, и повтор запроса (уже без изменения
+        КБЖУ) всё равно поставит пересчёт
+        """
+        redis = await redis_service.get_redis()
+        if not macros_changed and not await redis.sismember(
+            NUTRITION_PENDING_KEY, ingredient_id
+        ):
+            return
+
+        try:
+            await task_service.publish_task(
+                "recalculate_nutrition", {"ingredient_id": ingredient_id}
+            )
+        except Exception:
+            logger.exception(
+                "Failed to enqueue nutrition recalculation for ingredient %s",
+                ingredient_id,
+            )
+            await redis.sadd(NUTRITION_PENDING_KEY, ingredient_id)
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=(
+                    "Ingredient updated, but recipe nutrition recalculation "
+                    "could not be queued. Retry the request"
+                ),
+            )
+        await redis.srem(NUTRITION_PENDING_KEY, ingredient_id)
+
     async def delete_ingredient(self, ingredient_id: int) -> bool:
         """
         Удаление ингредиента
@@ -117,6 +200,8 @@ class IngredientService:
         try:
             ingredient = await Ingredient.get(id=ingredient_id)
             await ingredient.delete()
+            await ingredient_catalog.invalidate()
+            await substitute_index.refresh()
             return True
         except DoesNotExist:
             return False
@@ -125,65 +210,75 @@ class IngredientService:
         """
         Получить ВСЕ замены ингредиента
         """
-        substitutes = await Substitute.filter(original_ingredient_id=ingredient_id)
+        substitutes = await Substitute.filter(
+            original_ingredient_id=ingredient_id
+        ).select_related("substitute_ingredient")
 
-        result = []
-        for substitute in substitutes:
-            sub_ingredient = await Ingredient.get(id=substitute.substitute_ingredient)
-            result.append(
-                {
-                    "id": substitute.id,
-                    "original_ingredient_id": substitute.original_ingredient,
-                    "substitute_ingredient_id": substitute.substitute_ingredient,
-                    "substitute_name": sub_ingredient.name,
-                    "coefficient": substitute.coefficient,
-                    "created_at": substitute.created_at,
-                }
-            )
-
-        return result
+        return [_substitute_to_dict(substitute) for substitute in substitutes]
 
-    async def get_all_substitutes(self) -> List[Dict[str, Any]]:
+    async def get_all_substitutes(
+        self, size: int = 50, cursor: Optional[str] = None
+    ) -> dict:
         """
-        Получить все замены ингредиентов
+        Получить все замены ингредиентов с пагинацией (названия - одним JOIN)
         """
-        substitutes = await Substitute.all()
+        query = Substitute.all().select_related(
+            "original_ingredient", "substitute_ingredient"
+        )
+
+        if cursor:
+            try:
+                cursor_id = int(cursor)
+                query = query.filter(id__gt=cursor_id)
+            except Exception:
+                pass
+
+        substitutes = await query.order_by("id").limit(size + 1)
+
+        has_more = len(substitutes) > size
+        next_cursor = None
+        if substitutes and has_more:
+            substitutes = substitutes[:-1]
+            next_cursor = str(substitutes[-1].id)
 
-        result = []
-        for substitute in substitutes:
-            orig_ingredient = await Ingredient.get(id=substitute.original_ingredient)
-            sub_ingredient = await Ingredient.get(id=substitute.substitute_ingredient)
-            result.append(
+        return {
+            "data": [
                 {
-                    "id": substitute.id,
-                    "original_ingredient_id": substitute.original_ingredient,
-                    "substitute_ingredient_id": substitute.substitute_ingredient,
-                    "original_name": orig_ingredient.name,
-                    "substitute_name": sub_ingredient.name,
-                    "coefficient": substitute.coefficient,
-                    "created_at": substitute.created_at,
+                    **_substitute_to_dict(substitute),
+                    "original_name": substitute.original_ingredient.name,
                 }
-            )
+                for substitute in substitutes
+            ],
+            "next_cursor": next_cursor,
+            "has_more": has_more,
+        }
+
+    async def get_substitute_map(
+        self, ingredient_ids: Iterable[int], preference: str = "closest"
+    ) -> Dict[int, Dict[str, Any]]:
+        """
+        Лучшие доступные замены для каждого из недоступных ингредиентов
+        (из индекса в памяти, с учётом цепочек замен)
+        """
+        unavailable_ids = set(ingredient_ids)
+        await substitute_index.ensure_current()
 
+        result = {}
+        for ingredient_id in unavailable_ids:
+            substitute = substitute_index.resolve(
+                ingredient_id, unavailable_ids, preference
+            )
+            if substitute:
+                result[ingredient_id] = substitute
         return result
 
-    async def get_substitute(self, ingredient_id: int) -> Optional[Dict[str, Any]]:
+    async def get_substitutable_ids(self, available_ids: Iterable[int]) -> Set[int]:
         """
-        Получаем первую замену для ингредиента
+        ID ингредиентов, которые можно заменить чем-то из available_ids
+        (по индексу замен в памяти)
         """
-        try:
-            substitute = await Substitute.filter(
-                original_ingredient_id=ingredient_id
-            ).first()
-            if substitute:
-                return {
-                    "original_ingredient_id": substitute.original_ingredient,
-                    "substitute_ingredient_id": substitute.substitute_ingredient,
-                    "coefficient": substitute.coefficient,
-                }
-            return None
-        except Exception:
-            return None
+        await substitute_index.ensure_loaded()
+        return substitute_index.substitutable(available_ids)
 
     async def create_substitute(self, substitute_data: Dict[str, Any]) -> Substitute:
         """
@@ -209,6 +304,8 @@ class IngredientService:
             )
 
         substitute = await Substitute.create(**substitute_data)
+        await redis_service.bump_namespace(SUBSTITUTES_NAMESPACE)
+        await substitute_index.refresh()
         return substitute
 
     async def delete_substitute(self, substitute_id: int) -> bool:
@@ -218,6 +315,8 @@ class IngredientService:
         try:
             substitute = await Substitute.get(id=substitute_id)
             await substitute.delete()
+            await redis_service.bump_namespace(SUBSTITUTES_NAMESPACE)
+            await substitute_index.refresh()
             return True
         except DoesNotExist:
             return False
@@ -0,0 +1,82 @@
+import fnmatch
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+
+class LocalCache:
+    """
+    LRU-кэш в памяти процесса с TTL, ограниченный по числу элементов и байтам.
+
+    Значения отдаются без копирования, поэтому их нельзя изменять.
+    """
+
+    def __init__(self, max_items: int, max_bytes: int, ttl: float) -> None:
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: OrderedDict[str, Tuple[float, int, Any]] = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, _, value = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any, size: int, ttl: Optional[float] = None):
+        self._remove(key)
+        if size > self.max_bytes:
+            return
+
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._entries[key] = (time.monotonic() + ttl, size, value)
+        self._bytes += size
+
+        while len(self._entries) > self.max_items or self._bytes > self.max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def delete(self, keys: Iterable[str]):
+        for key in keys:
+            self._remove(key)
+
+    def delete_by_pattern(self, pattern: str):
+        for key in fnmatch.filter(list(self._entries), pattern):
+            self._remove(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "items": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,292 @@
+import asyncio
+import json
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from app.config import settings
+from app.db.mongodb import get_mongodb
+from app.services.redis_service import redis_service
+
+PANTRY_VERSION_KEY = "pantry_index:version"
+PANTRY_CHANGES_KEY = "pantry_index:changes"
+
+# Атомарно: новая версия + запись в журнал изменений (хранится хвост журнала)
+RECORD_CHANGES_SCRIPT = """
+local version = tonumber(redis.call("get", KEYS[1]) or "0")
+for i = 2, #ARGV do
+    version = version + 1
+    redis.call("rpush", KEYS[2], version .. "|" .. ARGV[i])
+end
+redis.call("set", KEYS[1], version)
+redis.call("ltrim", KEYS[2], -tonumber(ARGV[1]), -1)
+return version
+"""
+
+# Атомарно: текущая версия + изменения после известной нам версии
+READ_CHANGES_SCRIPT = """
+local version = tonumber(redis.call("get", KEYS[1]) or "0")
+local count = version - tonumber(ARGV[1])
+if count <= 0 then
+    return {version, {}}
+end
+return {version, redis.call("lrange", KEYS[2], -count, -1)}
+"""
+
+# Атомарно: новая версия без записей в журнале - воркеры увидят разрыв
+# и перечитают индекс целиком
+RESET_CHANGES_SCRIPT = """
+redis.call("del", KEYS[2])
+return redis.call("incr", KEYS[1])
+"""
+
+# Изменение индекса: ID рецепта и его ингредиенты (None - рецепт удалён)
+Change = Tuple[str, Optional[List[int]]]
+
+
+class PantryIndex:
+    """
+    Инвертированный индекс "ингредиент -> рецепты" в памяти процесса.
+
+    Рецепты пронумерованы плотными позициями, для каждого ингредиента
+    хранится отсортированный массив позиций рецептов. Новые рецепты
+    получают следующую позицию, поэтому массивы остаются отсортированными
+    при дописывании, а удалённые позиции просто помечаются мёртвыми и
+    вычищаются при полной перезагрузке.
+
+    Изменения рецептов пишутся в журнал в Redis с версией, воркеры в фоне
+    дочитывают журнал и применяют только новые записи. Если журнал уже
+    обрезан, индекс перечитывается из MongoDB целиком.
+    """
+
+    def __init__(self) -> None:
+        self._recipe_ids: List[str] = []
+        self._positions: Dict[str, int] = {}
+        self._postings: Dict[int, np.ndarray] = {}
+        self._required = np.zeros(0, dtype=np.int32)
+        self._alive = np.zeros(0, dtype=bool)
+        self._dead = 0
+        self._version: Optional[int] = None
+        self._loaded = False
+        self._lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._loaded
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    async def load(self):
+        """
+        Построить индекс заново по всем рецептам MongoDB
+        """
+        redis = await redis_service.get_redis()
+        version = int(await redis.get(PANTRY_VERSION_KEY) or 0)
+
+        db = await get_mongodb()
+        recipe_ids: List[str] = []
+        required: List[int] = []
+        postings: Dict[int, List[int]] = {}
+
+        async for recipe in db.recipes.find({}, {"ingredient_ids": 1}):
+            position = len(recipe_ids)
+            ingredient_ids = recipe.get("ingredient_ids") or []
+            recipe_ids.append(str(recipe["_id"]))
+            required.append(len(ingredient_ids))
+            for ingredient_id in ingredient_ids:
+                postings.setdefault(ingredient_id, []).append(position)
+
+        self._recipe_ids = recipe_ids
+        self._positions = {
+            recipe_id: position for position, recipe_id in enumerate(recipe_ids)
+        }
+        self._postings = {
+            ingredient_id: np.array(positions, dtype=np.int32)
+            for ingredient_id, positions in postings.items()
+        }
+        self._required = np.array(required, dtype=np.int32)
+        self._alive = np.ones(len(recipe_ids), dtype=bool)
+        self._dead = 0
+        self._version = version
+        self._loaded = True
+
+    def _apply(self, changes: Iterable[Change]):
+        """
+        Применить пачку изменений: удалить старые позиции, дописать новые
+        """
+        offset = len(self._recipe_ids)
+        new_required: List[int] = []
+        new_alive: List[bool] = []
+        new_postings: Dict[int, List[int]] = {}
+
+        for recipe_id, ingredient_ids in changes:
+            position = self._positions.pop(recipe_id, None)
+            if position is not None:
+                if position < offset:
+                    self._alive[position] = False
+                else:
+                    new_alive[position - offset] = False
+                self._dead += 1
+
+            if ingredient_ids is None:
+                continue
+
+            position = offset + len(new_required)
+            self._recipe_ids.append(recipe_id)
+            self._positions[recipe_id] = position
+            new_required.append(len(ingredient_ids))
+            new_alive.append(True)
+            for ingredient_id in ingredient_ids:
+                new_postings.setdefault(ingredient_id, []).append(position)
+
+        if not new_required:
+            return
+
+        self._required = np.concatenate(
+            [self._required, np.array(new_required, dtype=np.int32)]
+        )
+        self._alive = np.concatenate([self._alive, np.array(new_alive, dtype=bool)])
+        for ingredient_id, positions in new_postings.items():
+            added = np.array(positions, dtype=np.int32)
+            current = self._postings.get(ingredient_id)
+            self._postings[ingredient_id] = (
+                added if current is None else np.concatenate([current, added])
+            )
+
+    async def sync(self):
+        """
+        Дочитать журнал изменений из Redis
+        """
+        async with self._lock:
+            if not self._loaded:
+                await self.load()
+                return
+
+            redis = await redis_service.get_redis()
+            version, entries = await redis.eval(
+                READ_CHANGES_SCRIPT,
+                2,
+                PANTRY_VERSION_KEY,
+                PANTRY_CHANGES_KEY,
+                self._version,
+            )
+            version = int(version)
+            if version == self._version:
+                return
+
+            # Журнал обрезан или Redis очищен - пропущенное не восстановить
+            if version < self._version or len(entries) < version - self._version:
+                await self.load()
+                return
+
+            changes = []
+            for entry in entries:
+                _, payload = entry.decode().split("|", 1)
+                recipe_id, ingredient_ids = json.loads(payload)
+                changes.append((recipe_id, ingredient_ids))
+            self._apply(changes)
+            self._version = version
+
+            # Слишком много мёртвых позиций - дешевле перестроить
+            if self._dead > len(self._recipe_ids) // 4:
+                await self.load()
+
+    async def ensure_loaded(self):
+        if not self._loaded:
+            await self.sync()
+
+    async def record_changes(self, changes: List[Change]):
+        """
+        Записать изменения рецептов в журнал и сразу применить их у себя
+        """
+        if not changes:
+            return
+
+        redis = await redis_service.get_redis()
+        await redis.eval(
+            RECORD_CHANGES_SCRIPT,
+            2,
+            PANTRY_VERSION_KEY,
+            PANTRY_CHANGES_KEY,
+            settings.PANTRY_INDEX_CHANGELOG_SIZE,
+            *[json.dumps([recipe_id, ids]) for recipe_id, ids in changes],
+        )
+        if self._loaded:
+            await self.sync()
+
+    async def invalidate(self):
+        """
+        Заставить все воркеры перечитать индекс целиком - после массовых
+        изменений рецептов, которые не поместятся в журнал
+        """
+        redis = await redis_service.get_redis()
+        await redis.eval(RESET_CHANGES_SCRIPT, 2, PANTRY_VERSION_KEY, PANTRY_CHANGES_KEY)
+        if self._loaded:
+            await self.sync()
+
+    def match(
+        self,
+        ingredient_ids: Set[int],
+        min_coverage: float = 0.0,
+        offset: int = 0,
+        limit: int = 30,
+    ) -> Tuple[List[Tuple[str, float]], int]:
+        """
+        Страница рецептов по убыванию покрытия (доли ингредиентов рецепта из
+        ingredient_ids; при равном покрытии выше рецепты с большим числом
+        совпадений) и общее число подходящих рецептов
+        """
+        postings = [
+            self._postings[ingredient_id]
+            for ingredient_id in ingredient_ids
+            if ingredient_id in self._postings
+        ]
+        if not postings:
+            return [], 0
+
+        matched = np.bincount(
+            np.concatenate(postings), minlength=len(self._recipe_ids)
+        )
+        candidates = np.flatnonzero((matched > 0) & self._alive)
+        matched = matched[candidates]
+        coverage = matched / self._required[candidates]
+
+        keep = coverage >= min_coverage
+        candidates, matched, coverage = candidates[keep], matched[keep], coverage[keep]
+
+        # lexsort сортирует по последнему ключу первым
+        order = np.lexsort((candidates, -matched, -coverage))[offset : offset + limit]
+        page = [
+            (self._recipe_ids[position], float(coverage[i]))
+            for i, position in zip(order, candidates[order])
+        ]
+        return page, len(candidates)
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(settings.PANTRY_INDEX_REFRESH_SECONDS)
+            try:
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Pantry index refresh failed: {e}")
+
+    async def start(self):
+        await self.sync()
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+        print(f"✅ Pantry index loaded - {len(self)} recipes")
+
+    async def stop(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+
+
+pantry_index = PantryIndex()
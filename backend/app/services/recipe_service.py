@@ -1,14 +1,140 @@
+import copy
+import logging
+import zlib
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
 
+import orjson
 from bson import ObjectId
+from pydantic import ValidationError
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 from fastapi import HTTPException, status
 from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
 
+from app.config import settings
 from app.db.mongodb import get_mongodb
 from app.models.mongo.recipe import Recipe, RecipeIngredient, RecipeInstruction
+from app.schemas.recipe import RecipeCreate, RecipeResponse
 from app.services.ingredient_service import IngredientService
+from app.services.pantry_index import pantry_index
 from app.services.redis_service import redis_service
+from app.services.substitute_index import substitute_index
+from app.utils import cache_codec
+from app.utils.ingredients import recipe_ingredient_ids
+from app.utils.nutrition import apply_nutrition
+
+logger = logging.getLogger(__name__)
+
+RECIPES_LIST_NAMESPACE = "recipes_list"
+
+# Поля страницы списка по умолчанию - то, что показывает карточка рецепта
+LIST_SUMMARY_FIELDS = (
+    "name",
+    "description",
+    "category_id",
+    "cook_time_minutes",
+    "portions",
+    "difficulty",
+    "total_calories",
+    "calories_per_portion",
+    "protein_per_portion",
+    "fat_per_portion",
+    "carbs_per_portion",
+)
+LIST_ALLOWED_FIELDS = frozenset(RecipeResponse.model_fields) - {"id"}
+
+# Поля, от которых зависит КБЖУ рецепта
+NUTRITION_FIELDS = ("ingredients", "portions")
+
+# Поля, по которым рецепт попадает в теги страниц списка (см. _recipe_tag_groups)
+LIST_TAG_FIELDS = ("category_id", "total_calories", "cook_time_minutes")
+
+# Полное обновление (PUT) задаёт все поля рецепта - читать старую версию не нужно
+FULL_UPDATE_FIELDS = frozenset(RecipeCreate.model_fields)
+
+# Попытки обновления, если рецепт успели изменить между чтением и записью
+UPDATE_ATTEMPTS = 3
+
+# Ширина бакетов, по которым тегируются страницы списка рецептов
+CALORIES_BUCKET_SIZE = 100
+TIME_BUCKET_SIZE = 15
+MAX_TAG_BUCKETS = 50
+
+
+def _range_tags(
+    dimension: str, low: Optional[float], high: Optional[float], bucket_size: int
+) -> List[str]:
+    """
+    Теги бакетов, которые покрывает фильтр [low, high]
+    """
+    if high is None:
+        return [f"{dimension}:*"]
+
+    first = int(max(low or 0, 0) // bucket_size)
+    last = int(high // bucket_size)
+    if last - first + 1 > MAX_TAG_BUCKETS:
+        return [f"{dimension}:*"]
+
+    return [f"{dimension}:{bucket}" for bucket in range(first, last + 1)]
+
+
+def _list_page_tags(
+    category_id: Optional[int],
+    min_calories: Optional[float],
+    max_calories: Optional[float],
+    max_time: Optional[int],
+) -> List[str]:
+    """
+    Теги страницы списка: какие категории и бакеты калорий/времени она покрывает
+    """
+    tags = [f"category:{category_id}" if category_id else "category:*"]
+    tags += _range_tags("calories", min_calories, max_calories, CALORIES_BUCKET_SIZE)
+    tags += _range_tags("time", None, max_time or None, TIME_BUCKET_SIZE)
+    return tags
+
+
+async def _iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, bytes]]:
+    """
+    Непустые строки потока с их номерами (с 1), без чтения тела целиком
+    """
+    line_number = 0
+    tail = b""
+    async for chunk in chunks:
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield line_number, line
+    if tail.strip():
+        yield line_number + 1, tail
+
+
+def _validation_message(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(map(str, item['loc']))}: {item['msg']}" for item in error.errors()
+    )
+
+
+def _to_response(recipe: Dict[str, Any]) -> dict:
+    """
+    Рецепт в форме ответа API - именно в таком виде он лежит в кэше
+    """
+    return RecipeResponse.model_validate(recipe).model_dump(mode="json")
+
+
+def _recipe_tag_groups(recipe: Dict[str, Any]) -> List[List[str]]:
+    """
+    Группы тегов страниц, в которые может попасть рецепт
+    """
+    calories_bucket = int(recipe["total_calories"] // CALORIES_BUCKET_SIZE)
+    time_bucket = int(recipe["cook_time_minutes"] // TIME_BUCKET_SIZE)
+    return [
+        [f"category:{recipe['category_id']}", "category:*"],
+        [f"calories:{calories_bucket}", "calories:*"],
+        [f"time:{time_bucket}", "time:*"],
+    ]
 
 
 class RecipeService:
@@ -23,27 +149,40 @@ class RecipeService:
             self.collection = self.db.recipes
         return self.collection
 
-    async def get_recipes(
-        self,
+    @staticmethod
+    def _list_key(version: int, key: str) -> str:
+        return f"{RECIPES_LIST_NAMESPACE}:v{version}:{key}"
+
+    async def _invalidate_list_cache(self, *recipes: Dict[str, Any]):
+        """
+        Сбросить только те страницы списка, в которые могли попасть рецепты
+        (для обновления передаются старая и новая версии)
+        """
+        version = await redis_service.get_namespace_version(RECIPES_LIST_NAMESPACE)
+        for recipe in recipes:
+            await redis_service.delete_by_tags(
+                [
+                    [self._list_key(version, f"tag:{tag}") for tag in group]
+                    for group in _recipe_tag_groups(recipe)
+                ]
+            )
+
+    @staticmethod
+    def build_list_filters(
         cursor: Optional[str] = None,
-        size: int = 30,
-        category_id: Optional[str] = None,
+        category_id: Optional[int] = None,
         min_calories: Optional[float] = None,
         max_calories: Optional[float] = None,
         max_time: Optional[int] = None,
         exclude_ingredients: Optional[List[int]] = None,
+        include_ingredients: Optional[List[int]] = None,
+        include_mode: str = "all",
     ) -> dict:
         """
-        Получить писок рецептов с пагинацией (cursor-based)
-        """
-        # Try to get from cache
-        cache_key = f"recipes_list:{cursor}:{size}:{category_id}:{min_calories}:{max_calories}:{max_time}:{exclude_ingredients}"
-        cached_data = await redis_service.get(cache_key)
-        if cached_data:
-            return cached_data
-
-        collection = await self._get_collection()
+        Фильтр MongoDB для списка рецептов (формы запросов покрыты app.db.indexes)
 
+        include_mode: "all" - рецепт содержит все include_ingredients, "any" - хотя бы один
+        """
         filters = {}
 
         if category_id:
@@ -59,8 +198,13 @@ class RecipeService:
         if max_time:
             filters["cook_time_minutes"] = {"$lte": max_time}
 
-        if exclude_ingredients:
-            filters["ingredients.ingredients_id"] = {"$nin": exclude_ingredients}
+        if exclude_ingredients or include_ingredients:
+            filters["ingredient_ids"] = {}
+            if exclude_ingredients:
+                filters["ingredient_ids"]["$nin"] = exclude_ingredients
+            if include_ingredients:
+                operator = "$in" if include_mode == "any" else "$all"
+                filters["ingredient_ids"][operator] = include_ingredients
 
         if cursor:
             try:
@@ -68,107 +212,278 @@ class RecipeService:
             except Exception:
                 pass
 
-        recipes = (
-            await collection.find(filters)
-            .sort("_id", 1)
-            .limit(size + 1)
-            .to_list(size + 1)
+        return filters
+
+    async def get_recipes(
+        self,
+        cursor: Optional[str] = None,
+        size: int = 30,
+        category_id: Optional[str] = None,
+        min_calories: Optional[float] = None,
+        max_calories: Optional[float] = None,
+        max_time: Optional[int] = None,
+        exclude_ingredients: Optional[List[int]] = None,
+        include_ingredients: Optional[List[int]] = None,
+        include_mode: str = "all",
+        fields: Optional[List[str]] = None,
+        as_json: bool = False,
+    ) -> dict | bytes:
+        """
+        Получить писок рецептов с пагинацией (cursor-based)
+
+        fields - какие поля рецептов вернуть (по умолчанию краткая карточка),
+        as_json=True возвращает готовое тело ответа из кэша без разбора
+        """
+        if fields:
+            unknown_fields = set(fields) - LIST_ALLOWED_FIELDS
+            if unknown_fields:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Unknown fields: {', '.join(sorted(unknown_fields))}",
+                )
+            fields = sorted(set(fields))
+        else:
+            fields = LIST_SUMMARY_FIELDS
+        projection = {field: 1 for field in fields}
+
+        exclude_ingredients = sorted(set(exclude_ingredients or [])) or None
+        include_ingredients = sorted(set(include_ingredients or [])) or None
+
+        version = await redis_service.get_namespace_version(RECIPES_LIST_NAMESPACE)
+        cache_key = self._list_key(
+            version,
+            f"page:{cursor}:{size}:{category_id}:{min_calories}:{max_calories}:{max_time}:{exclude_ingredients}:{include_ingredients}:{include_mode}:{','.join(fields)}",
         )
 
-        has_more = len(recipes) > size
-        if has_more:
-            recipes = recipes[:size]
+        async def load() -> dict:
+            collection = await self._get_collection()
+
+            filters = self.build_list_filters(
+                cursor=cursor,
+                category_id=category_id,
+                min_calories=min_calories,
+                max_calories=max_calories,
+                max_time=max_time,
+                exclude_ingredients=exclude_ingredients,
+                include_ingredients=include_ingredients,
+                include_mode=include_mode,
+            )
+
+            recipes = (
+                await collection.find(filters, projection)
+                .sort("_id", 1)
+                .limit(size + 1)
+                .to_list(size + 1)
+            )
 
-        next_cursor = None
-        if recipes and has_more:
-            next_cursor = str(recipes[-1]["_id"])
+            has_more = len(recipes) > size
+            if has_more:
+                recipes = recipes[:size]
 
-        # Convert _id to id for serialization
-        for recipe in recipes:
+            next_cursor = None
+            if recipes and has_more:
+                next_cursor = str(recipes[-1]["_id"])
+
+            # Convert _id to id for serialization
+            for recipe in recipes:
+                recipe["id"] = str(recipe.pop("_id"))
+
+            return {
+                "data": recipes,
+                "next_cursor": next_cursor,
+                "has_more": has_more,
+            }
+
+        data = await redis_service.get_or_set_raw(
+            cache_key,
+            load,
+            expire=settings.RECIPES_LIST_CACHE_TTL,
+            stale_ttl=settings.RECIPES_LIST_CACHE_STALE_TTL,
+            tags=[
+                self._list_key(version, f"tag:{tag}")
+                for tag in _list_page_tags(
+                    category_id, min_calories, max_calories, max_time
+                )
+            ],
+        )
+        return cache_codec.to_json(data) if as_json else cache_codec.decode(data)
+
+    async def export_recipes(
+        self,
+        category_id: Optional[int] = None,
+        min_calories: Optional[float] = None,
+        max_calories: Optional[float] = None,
+        max_time: Optional[int] = None,
+        exclude_ingredients: Optional[List[int]] = None,
+        include_ingredients: Optional[List[int]] = None,
+        include_mode: str = "all",
+        compress: bool = False,
+    ) -> AsyncIterator[bytes]:
+        """
+        Выгрузка рецептов в NDJSON прямо из курсора MongoDB, мимо кэша
+
+        Фильтры те же, что у get_recipes. В памяти держится одна пачка
+        курсора; каждая пачка отдаётся одним куском (с compress=True - gzip)
+        """
+        collection = await self._get_collection()
+        filters = self.build_list_filters(
+            category_id=category_id,
+            min_calories=min_calories,
+            max_calories=max_calories,
+            max_time=max_time,
+            exclude_ingredients=exclude_ingredients,
+            include_ingredients=include_ingredients,
+            include_mode=include_mode,
+        )
+        projection = dict.fromkeys(LIST_ALLOWED_FIELDS, 1)
+        batch_size = settings.RECIPE_EXPORT_BATCH_SIZE
+
+        # wbits=31 - формат gzip, а не голый zlib
+        compressor = zlib.compressobj(wbits=31) if compress else None
+
+        def encode(lines: List[bytes]) -> bytes:
+            chunk = b"".join(lines)
+            return compressor.compress(chunk) if compressor else chunk
+
+        cursor = (
+            collection.find(filters, projection).sort("_id", 1).batch_size(batch_size)
+        )
+        lines = []
+        async for recipe in cursor:
             recipe["id"] = str(recipe.pop("_id"))
+            lines.append(orjson.dumps(recipe, option=orjson.OPT_APPEND_NEWLINE))
+            if len(lines) >= batch_size:
+                chunk = encode(lines)
+                lines = []
+                if chunk:
+                    yield chunk
 
-        result = {
-            "data": recipes,
-            "next_cursor": next_cursor,
-            "has_more": has_more,
-        }
-        await redis_service.set(cache_key, result, expire=600)  # Cache for 10 minutes
-        return result
+        if lines:
+            yield encode(lines)
+        if compressor:
+            yield compressor.flush()
 
-    async def get_recipe(self, recipe_id: str) -> Optional[dict]:
+    async def get_recipe(
+        self, recipe_id: str, as_json: bool = False
+    ) -> Optional[dict | bytes]:
         """
         Берем рецепт по его ID
-        """
-        # Try to get from cache
-        cache_key = f"recipe:{recipe_id}"
-        cached_recipe = await redis_service.get(cache_key)
-        if cached_recipe:
-            return cached_recipe
 
-        collection = await self._get_collection()
+        as_json=True возвращает готовое тело ответа из кэша без разбора
+        """
+        if not ObjectId.is_valid(recipe_id):
+            return None
 
-        try:
+        async def load() -> Optional[dict]:
+            collection = await self._get_collection()
             recipe = await collection.find_one({"_id": ObjectId(recipe_id)})
-            if recipe:
-                recipe["id"] = str(recipe.pop("_id"))
-                await redis_service.set(
-                    cache_key, recipe, expire=3600
-                )  # Cache for 1 hour
-            return recipe
-        except Exception:
+            if not recipe:
+                return None
+            recipe["id"] = str(recipe.pop("_id"))
+            return _to_response(recipe)
+
+        data = await redis_service.get_or_set_raw(
+            f"recipe:{recipe_id}",
+            load,
+            expire=settings.RECIPE_CACHE_TTL,
+            stale_ttl=settings.RECIPE_CACHE_STALE_TTL,
+        )
+        if data is None:
             return None
+        return cache_codec.to_json(data) if as_json else cache_codec.decode(data)
 
-    async def create_recipe(self, recipe_data: Dict[str, Any]) -> dict:
+    async def get_recipes_by_ids(
+        self, recipe_ids: List[str], as_json: bool = False
+    ) -> dict | bytes:
         """
-        Создание нового рецепта
+        Несколько рецептов за раз: один MGET в Redis, промахи - одним $in
+        запросом в MongoDB с дозаписью в кэш пайплайном
+
+        Рецепты идут в порядке recipe_ids; ненайденные ID - в not_found.
+        as_json=True собирает тело ответа из закэшированных байтов без разбора
         """
-        collection = await self._get_collection()
+        unique_ids = list(dict.fromkeys(recipe_ids))
+        valid_ids = [recipe_id for recipe_id in unique_ids if ObjectId.is_valid(recipe_id)]
 
-        recipe_dict = recipe_data.copy()
+        cached = await redis_service.get_many_raw(
+            [f"recipe:{recipe_id}" for recipe_id in valid_ids]
+        )
+        found: Dict[str, bytes] = {
+            recipe_id: data for recipe_id, data in zip(valid_ids, cached) if data
+        }
 
-        total_calories = 0
-        total_protein = 0
-        total_fat = 0
-        total_carbs = 0
+        missing_ids = [recipe_id for recipe_id in valid_ids if recipe_id not in found]
+        if missing_ids:
+            collection = await self._get_collection()
+            loaded = {}
+            async for recipe in collection.find(
+                {"_id": {"$in": [ObjectId(recipe_id) for recipe_id in missing_ids]}}
+            ):
+                recipe["id"] = str(recipe.pop("_id"))
+                loaded[f"recipe:{recipe['id']}"] = _to_response(recipe)
 
-        for ingredient in recipe_dict["ingredients"]:
-            ing_data = await self.ingredient_service.get_ingredient(
-                ingredient["ingredient_id"]
+            encoded = await redis_service.set_many(
+                loaded,
+                expire=settings.RECIPE_CACHE_TTL,
+                stale_ttl=settings.RECIPE_CACHE_STALE_TTL,
+            )
+            found.update(
+                {key.split(":", 1)[1]: data for key, data in encoded.items()}
             )
 
-            if not ing_data:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail=f"Ingredient with ID {ingredient['ingredient_id']} not found",
-                )
+        ordered = [found[recipe_id] for recipe_id in recipe_ids if recipe_id in found]
+        not_found = [recipe_id for recipe_id in unique_ids if recipe_id not in found]
+
+        if as_json:
+            return b"".join(
+                [
+                    b'{"data":[',
+                    b",".join(cache_codec.to_json(data) for data in ordered),
+                    b'],"not_found":',
+                    orjson.dumps(not_found),
+                    b"}",
+                ]
+            )
+        return {
+            "data": [cache_codec.decode(data) for data in ordered],
+            "not_found": not_found,
+        }
 
-            quantity = ingredient["quantity"]
-            calories = (ing_data["calories_per_100g"] / 100) * quantity
-            protein = (ing_data["protein_per_100g"] / 100) * quantity
-            fat = (ing_data["fat_per_100g"] / 100) * quantity
-            carbs = (ing_data["carbs_per_100g"] / 100) * quantity
+    async def _get_ingredients_map(
+        self, recipes_data: List[Dict[str, Any]]
+    ) -> Dict[int, Dict[str, Any]]:
+        """
+        Загрузить все ингредиенты рецептов одним запросом
+        """
+        ingredient_ids = {
+            ingredient["ingredient_id"]
+            for recipe in recipes_data
+            for ingredient in recipe["ingredients"]
+        }
+        ingredients_map = await self.ingredient_service.get_ingredients_by_ids(
+            ingredient_ids
+        )
 
-            ingredient["calories"] = calories
-            ingredient["protein"] = protein
-            ingredient["fat"] = fat
-            ingredient["carbs"] = carbs
+        missing_ids = sorted(ingredient_ids - ingredients_map.keys())
+        if missing_ids:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Ingredients with IDs {', '.join(map(str, missing_ids))} not found",
+            )
 
-            total_calories += calories
-            total_protein += protein
-            total_fat += fat
-            total_carbs += carbs
+        return ingredients_map
 
-        portions = recipe_dict["portions"]
+    async def create_recipe(self, recipe_data: Dict[str, Any]) -> dict:
+        """
+        Создание нового рецепта
+        """
+        collection = await self._get_collection()
 
-        recipe_dict["total_calories"] = round(total_calories, 2)
-        recipe_dict["total_protein"] = round(total_protein, 2)
-        recipe_dict["total_fat"] = round(total_fat, 2)
-        recipe_dict["total_carbs"] = round(total_carbs, 2)
+        recipe_dict = recipe_data.copy()
 
-        recipe_dict["calories_per_portion"] = round(total_calories / portions, 2)
-        recipe_dict["protein_per_portion"] = round(total_protein / portions, 2)
-        recipe_dict["fat_per_portion"] = round(total_fat / portions, 2)
-        recipe_dict["carbs_per_portion"] = round(total_carbs / portions, 2)
+        ingredients_map = await self._get_ingredients_map([recipe_dict])
+        apply_nutrition([recipe_dict], ingredients_map)
+        recipe_dict["ingredient_ids"] = recipe_ingredient_ids(recipe_dict)
 
         recipe_dict["created_at"] = datetime.utcnow()
         recipe_dict["updated_at"] = datetime.utcnow()
@@ -176,123 +491,538 @@ class RecipeService:
         result = await collection.insert_one(recipe_dict)
 
         # Invalidate list cache
-        await redis_service.delete_by_pattern("recipes_list:*")
+        await self._invalidate_list_cache(recipe_dict)
+        await pantry_index.record_changes(
+            [(str(result.inserted_id), recipe_dict["ingredient_ids"])]
+        )
 
         return await self.get_recipe(str(result.inserted_id))
 
+    async def create_recipes(self, recipes_data: List[Dict[str, Any]]) -> List[str]:
+        """
+        Массовое создание рецептов (ингредиенты загружаются одним запросом)
+        """
+        if not recipes_data:
+            return []
+
+        collection = await self._get_collection()
+
+        recipe_dicts = [recipe_data.copy() for recipe_data in recipes_data]
+        ingredients_map = await self._get_ingredients_map(recipe_dicts)
+        apply_nutrition(recipe_dicts, ingredients_map)
+
+        now = datetime.utcnow()
+        for recipe_dict in recipe_dicts:
+            recipe_dict["ingredient_ids"] = recipe_ingredient_ids(recipe_dict)
+            recipe_dict["created_at"] = now
+            recipe_dict["updated_at"] = now
+
+        result = await collection.insert_many(recipe_dicts)
+
+        # Bulk insert touches many pages, drop the whole list namespace
+        await redis_service.bump_namespace(RECIPES_LIST_NAMESPACE)
+
+        recipe_ids = [str(inserted_id) for inserted_id in result.inserted_ids]
+        await pantry_index.record_changes(
+            [
+                (recipe_id, recipe_dict["ingredient_ids"])
+                for recipe_id, recipe_dict in zip(recipe_ids, recipe_dicts)
+            ]
+        )
+
+        return recipe_ids
+
+    async def import_recipes(self, chunks: AsyncIterator[bytes]) -> dict:
+        """
+        Импорт рецептов из потока NDJSON (один рецепт в строке)
+
+        Строки проверяются и считаются пачками, пачка пишется одним
+        неупорядоченным insert_many. Ошибка в строке не останавливает
+        импорт - она попадает в отчёт с номером строки. Кэш списка
+        сбрасывается один раз в конце.
+        """
+        report = {"inserted": 0, "failed": 0, "errors": []}
+
+        def fail(line_number: int, error: str):
+            report["failed"] += 1
+            if len(report["errors"]) < settings.RECIPE_IMPORT_MAX_ERRORS:
+                report["errors"].append({"line": line_number, "error": error})
+
+        batch: List[Tuple[int, Dict[str, Any]]] = []
+        try:
+            async for line_number, line in _iter_lines(chunks):
+                try:
+                    recipe = RecipeCreate.model_validate(orjson.loads(line))
+                except orjson.JSONDecodeError as e:
+                    fail(line_number, f"Invalid JSON: {e}")
+                    continue
+                except ValidationError as e:
+                    fail(line_number, _validation_message(e))
+                    continue
+
+                if len(recipe.ingredients) < 2 or len(recipe.ingredients) > 30:
+                    fail(line_number, "Recipe must have between 2 and 30 ingredients")
+                    continue
+
+                batch.append((line_number, recipe.dict()))
+                if len(batch) >= settings.RECIPE_IMPORT_BATCH_SIZE:
+                    report["inserted"] += await self._import_batch(batch, fail)
+                    batch = []
+
+            if batch:
+                report["inserted"] += await self._import_batch(batch, fail)
+        finally:
+            # Даже если поток оборвался, уже записанные рецепты должны
+            # появиться в списках
+            if report["inserted"]:
+                await redis_service.bump_namespace(RECIPES_LIST_NAMESPACE)
+
+        return report
+
+    async def _import_batch(
+        self,
+        batch: List[Tuple[int, Dict[str, Any]]],
+        fail: Callable[[int, str], None],
+    ) -> int:
+        """
+        Посчитать КБЖУ и записать пачку импорта, вернуть число записанных
+        """
+        collection = await self._get_collection()
+
+        ingredients_map = await self.ingredient_service.get_ingredients_by_ids(
+            ingredient["ingredient_id"]
+            for _, recipe in batch
+            for ingredient in recipe["ingredients"]
+        )
+
+        lines = []
+        recipes = []
+        for line_number, recipe in batch:
+            missing_ids = sorted(
+                {ingredient["ingredient_id"] for ingredient in recipe["ingredients"]}
+                - ingredients_map.keys()
+            )
+            if missing_ids:
+                fail(
+                    line_number,
+                    f"Ingredients with IDs {', '.join(map(str, missing_ids))} not found",
+                )
+                continue
+            lines.append(line_number)
+            recipes.append(recipe)
+
+        if not recipes:
+            return 0
+
+        apply_nutrition(recipes, ingredients_map)
+        now = datetime.utcnow()
+        for recipe in recipes:
+            recipe["ingredient_ids"] = recipe_ingredient_ids(recipe)
+            recipe["created_at"] = now
+            recipe["updated_at"] = now
+
+        failed = set()
+        try:
+            await collection.insert_many(recipes, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                failed.add(error["index"])
+                fail(lines[error["index"]], error.get("errmsg", "Write failed"))
+
+        # _id проставляется драйвером до отправки, поэтому известен и при ошибках
+        inserted = [
+            recipe for index, recipe in enumerate(recipes) if index not in failed
+        ]
+        await pantry_index.record_changes(
+            [(str(recipe["_id"]), recipe["ingredient_ids"]) for recipe in inserted]
+        )
+        return len(inserted)
+
+    async def match_pantry(
+        self,
+        ingredient_ids: List[int],
+        use_substitutes: bool = False,
+        min_coverage: float = 0.0,
+        cursor: Optional[str] = None,
+        size: int = 30,
+    ) -> dict:
+        """
+        Что приготовить из имеющихся ингредиентов: рецепты по убыванию покрытия
+
+        use_substitutes=True засчитывает ингредиенты, у которых есть замена из
+        имеющихся; cursor - смещение в ранжированной выдаче
+        """
+        available = set(ingredient_ids)
+        if use_substitutes:
+            available |= await self.ingredient_service.get_substitutable_ids(available)
+
+        offset = int(cursor) if cursor and cursor.isdigit() else 0
+
+        await pantry_index.ensure_loaded()
+        page, total = pantry_index.match(available, min_coverage, offset, size)
+        has_more = offset + size < total
+
+        collection = await self._get_collection()
+        projection = {field: 1 for field in LIST_SUMMARY_FIELDS}
+        projection["ingredient_ids"] = 1
+        recipes = await collection.find(
+            {"_id": {"$in": [ObjectId(recipe_id) for recipe_id, _ in page]}},
+            projection,
+        ).to_list(len(page))
+        recipes_by_id = {str(recipe.pop("_id")): recipe for recipe in recipes}
+
+        data = []
+        for recipe_id, coverage in page:
+            recipe = recipes_by_id.get(recipe_id)
+            if recipe is None:
+                # Удалён, но индекс этого воркера ещё не догнал журнал
+                continue
+            recipe["id"] = recipe_id
+            recipe["coverage"] = round(coverage, 4)
+            recipe["missing_ingredient_ids"] = [
+                ingredient_id
+                for ingredient_id in recipe.pop("ingredient_ids", [])
+                if ingredient_id not in available
+            ]
+            data.append(recipe)
+
+        return {
+            "data": data,
+            "next_cursor": str(offset + size) if has_more else None,
+            "has_more": has_more,
+        }
+
+    async def recalculate_nutrition(
+        self, ingredient_id: int, batch_size: Optional[int] = None
+    ) -> int:
+        """
+        Пересчитать КБЖУ всех рецептов с ингредиентом (после изменения его КБЖУ)
+
+        Рецепты читаются курсором по индексу ingredient_ids и пишутся пачками
+        через bulk_write; рецепт, у которого за это время изменились
+        ингредиенты или порции, перечитывается и считается заново
+        """
+        batch_size = batch_size or settings.NUTRITION_RECALC_BATCH_SIZE
+        collection = await self._get_collection()
+        cursor = collection.find(
+            {"ingredient_ids": ingredient_id},
+            dict.fromkeys(NUTRITION_FIELDS, 1),
+            batch_size=batch_size,
+        )
+
+        updated = 0
+        batch = []
+        async for recipe in cursor:
+            batch.append(recipe)
+            if len(batch) >= batch_size:
+                updated += await self._write_nutrition(batch)
+                batch = []
+        if batch:
+            updated += await self._write_nutrition(batch)
+
+        if updated:
+            # Калории могли сдвинуться между бакетами - сбрасываем списки целиком
+            await redis_service.bump_namespace(RECIPES_LIST_NAMESPACE)
+        return updated
+
+    async def _write_nutrition(self, recipes: List[Dict[str, Any]]) -> int:
+        """
+        Записать КБЖУ пачки рецептов, повторяя для изменившихся между чтением
+        и записью (не больше UPDATE_ATTEMPTS раз)
+        """
+        collection = await self._get_collection()
+        updated = 0
+        for attempt in range(UPDATE_ATTEMPTS):
+            if attempt:
+                recipes = await collection.find(
+                    {"_id": {"$in": stale_ids}}, dict.fromkeys(NUTRITION_FIELDS, 1)
+                ).to_list(None)
+
+            written, stale_ids = await self._write_nutrition_batch(recipes)
+            updated += written
+            if not stale_ids:
+                return updated
+
+        logger.error(
+            "Nutrition recalculation gave up on recipes changed during it: %s",
+            ", ".join(str(recipe_id) for recipe_id in stale_ids),
+        )
+        return updated
+
+    async def _write_nutrition_batch(
+        self, recipes: List[Dict[str, Any]]
+    ) -> Tuple[int, List[ObjectId]]:
+        """
+        Один проход bulk_write. Рецепт пишется, только если его ингредиенты и
+        порции не изменились с момента чтения; возвращает число записанных и
+        ID рецептов, которые успели измениться
+        """
+        ingredients_map = await self.ingredient_service.get_ingredients_by_ids(
+            ingredient["ingredient_id"]
+            for recipe in recipes
+            for ingredient in recipe["ingredients"]
+        )
+        # Ингредиент рецепта удалён - пересчитать нечем
+        recipes = [
+            recipe
+            for recipe in recipes
+            if all(
+                ingredient["ingredient_id"] in ingredients_map
+                for ingredient in recipe["ingredients"]
+            )
+        ]
+        # Фильтр - значения полей КБЖУ в том виде, в каком они прочитаны
+        filters = [copy.deepcopy(recipe) for recipe in recipes]
+        apply_nutrition(recipes, ingredients_map)
+        now = datetime.utcnow()
+
+        operations = []
+        for recipe_filter, recipe in zip(filters, recipes):
+            recipe.pop("_id")
+            recipe["updated_at"] = now
+            operations.append(UpdateOne(recipe_filter, {"$set": recipe}))
+
+        if not operations:
+            return 0, []
+
+        collection = await self._get_collection()
+        result = await collection.bulk_write(operations, ordered=False)
+        await redis_service.delete(
+            *(f"recipe:{recipe_filter['_id']}" for recipe_filter in filters)
+        )
+        if result.matched_count == len(operations):
+            return result.modified_count, []
+
+        # Повторять нужно рецепты, в которых лежит не записанное нами;
+        # удалённые рецепты просто не найдутся
+        written = {
+            recipe_filter["_id"]: {
+                "_id": recipe_filter["_id"],
+                **{field: recipe[field] for field in NUTRITION_FIELDS},
+            }
+            for recipe_filter, recipe in zip(filters, recipes)
+        }
+        current = await collection.find(
+            {"_id": {"$in": list(written)}}, dict.fromkeys(NUTRITION_FIELDS, 1)
+        ).to_list(None)
+        stale_ids = [
+            recipe["_id"] for recipe in current if recipe != written[recipe["_id"]]
+        ]
+        return result.modified_count, stale_ids
+
     async def get_recipe_with_substitutes(
         self,
         recipe_id: str,
         unavailable_ingredients: List[Dict[str, int]],
-    ) -> Optional[dict]:
+        preference: str = "closest",
+        as_json: bool = False,
+    ) -> Optional[dict | bytes]:
         """
         Получить рецепт с заменами ингредиентов
+
+        preference - критерий выбора замены (см. SUBSTITUTE_PREFERENCES).
+        Результат кэшируется по версии рецепта (updated_at), версиям замен и
+        справочника ингредиентов и отсортированному набору заменяемых ID
         """
         recipe = await self.get_recipe(recipe_id)
         if not recipe:
             return None
 
-        modified_recipe = recipe.copy()
-        modified_recipe["ingredients"] = recipe["ingredients"].copy()
+        # Версии, по которым построен индекс замен этого процесса, а не
+        # последние в Redis - иначе отставший воркер положит под новый ключ
+        # результат по старым заменам
+        substitutes_version, ingredients_version = (
+            await substitute_index.ensure_current()
+        )
+
+        # В ключ попадают только ингредиенты рецепта и их возможные замены -
+        # так у разных пользователей с одними и теми же нехватками совпадает
+        # больше запросов
+        requested_ids = {ing["ingredient_id"] for ing in unavailable_ingredients}
+        missing_ids = requested_ids & {
+            ingredient["ingredient_id"] for ingredient in recipe["ingredients"]
+        }
+        unavailable_ids = sorted(
+            missing_ids
+            | (requested_ids & substitute_index.reachable(missing_ids, preference))
+        )
+        cache_key = (
+            f"recipe_substitutes:{recipe_id}:{recipe['updated_at']}"
+            f":v{substitutes_version}.{ingredients_version}:{preference}"
+            f":{','.join(map(str, unavailable_ids))}"
+        )
+
+        async def load() -> Optional[dict]:
+            return await self._apply_substitutes(
+                recipe, set(unavailable_ids), preference
+            )
 
-        unavailable_ids = [ing["ingredient_id"] for ing in unavailable_ingredients]
+        data = await redis_service.get_or_set_raw(
+            cache_key, load, expire=settings.RECIPE_SUBSTITUTES_CACHE_TTL
+        )
+        if data is None:
+            return None
+        return cache_codec.to_json(data) if as_json else cache_codec.decode(data)
 
-        new_ingredients = []
-        total_calories = 0
-        total_protein = 0
-        total_fat = 0
-        total_carbs = 0
+    async def _apply_substitutes(
+        self, recipe: Dict[str, Any], unavailable_ids: Set[int], preference: str
+    ) -> Optional[dict]:
+        """
+        Заменить недоступные ингредиенты и пересчитать КБЖУ
+        """
+        substitutes = await self.ingredient_service.get_substitute_map(
+            unavailable_ids, preference
+        )
 
-        for ingredient in modified_recipe["ingredients"]:
+        new_ingredients = []
+        for ingredient in recipe["ingredients"]:
+            ingredient = ingredient.copy()
             if ingredient["ingredient_id"] in unavailable_ids:
-                substitute = await self.ingredient_service.get_substitute(
-                    ingredient["ingredient_id"]
-                )
-
-                if substitute:
-                    new_ingredient = ingredient.copy()
-                    new_ingredient["ingredient_id"] = substitute[
-                        "substitute_ingredient_id"
-                    ]
-                    new_ingredient["quantity"] = (
-                        ingredient["quantity"] * substitute["coefficient"]
-                    )
-
-                    new_ing_data = await self.ingredient_service.get_ingredient(
-                        substitute["substitute_ingredient_id"]
-                    )
-
-                    if not new_ing_data:
-                        continue
-
-                    quantity = new_ingredient["quantity"]
-                    new_ingredient["calories"] = round(
-                        (new_ing_data["calories_per_100g"] / 100) * quantity, 2
-                    )
-                    new_ingredient["protein"] = round(
-                        (new_ing_data["protein_per_100g"] / 100) * quantity, 2
-                    )
-                    new_ingredient["fat"] = round(
-                        (new_ing_data["fat_per_100g"] / 100) * quantity, 2
-                    )
-                    new_ingredient["carbs"] = round(
-                        (new_ing_data["carbs_per_100g"] / 100) * quantity, 2
-                    )
-
-                    new_ingredients.append(new_ingredient)
-
-                    total_calories += new_ingredient["calories"]
-                    total_protein += new_ingredient["protein"]
-                    total_fat += new_ingredient["fat"]
-                    total_carbs += new_ingredient["carbs"]
-            else:
-                new_ingredients.append(ingredient)
-                total_calories += ingredient["calories"]
-                total_protein += ingredient["protein"]
-                total_fat += ingredient["fat"]
-                total_carbs += ingredient["carbs"]
+                substitute = substitutes.get(ingredient["ingredient_id"])
+                if not substitute:
+                    continue
+                ingredient["ingredient_id"] = substitute["substitute_ingredient_id"]
+                ingredient["quantity"] *= substitute["coefficient"]
+            new_ingredients.append(ingredient)
 
+        # КБЖУ всех ингредиентов берём из справочника в памяти
+        ingredients_map = await self.ingredient_service.get_ingredients_by_ids(
+            ingredient["ingredient_id"] for ingredient in new_ingredients
+        )
+        new_ingredients = [
+            ingredient
+            for ingredient in new_ingredients
+            if ingredient["ingredient_id"] in ingredients_map
+        ]
         if len(new_ingredients) < 2:
             return None
 
-        portions = modified_recipe["portions"]
-        modified_recipe["ingredients"] = new_ingredients
-        modified_recipe["total_calories"] = round(total_calories, 2)
-        modified_recipe["total_protein"] = round(total_protein, 2)
-        modified_recipe["total_fat"] = round(total_fat, 2)
-        modified_recipe["total_carbs"] = round(total_carbs, 2)
-
-        modified_recipe["calories_per_portion"] = round(total_calories / portions, 2)
-        modified_recipe["protein_per_portion"] = round(total_protein / portions, 2)
-        modified_recipe["fat_per_portion"] = round(total_fat / portions, 2)
-        modified_recipe["carbs_per_portion"] = round(total_carbs / portions, 2)
-
+        modified_recipe = {**recipe, "ingredients": new_ingredients}
+        apply_nutrition([modified_recipe], ingredients_map)
         return modified_recipe
 
     async def update_recipe(
-        self, recipe_id: str, recipe_data: Dict[str, Any]
+        self, recipe_id: str, changes: Dict[str, Any]
     ) -> Optional[dict]:
         """
-        Обновление рецепта
+        Обновление рецепта: полное (PUT) или частичное (PATCH)
+
+        КБЖУ пересчитывается, только если меняются ингредиенты или порции.
+        Новая версия рецепта сразу записывается в кэш вместо удаления ключа
+        """
+        if not ObjectId.is_valid(recipe_id):
+            return None
+        if not changes:
+            return await self.get_recipe(recipe_id)
+
+        if changes.keys() >= FULL_UPDATE_FIELDS:
+            previous, recipe = await self._replace_recipe(recipe_id, changes)
+        else:
+            previous, recipe = await self._patch_recipe(recipe_id, changes)
+        if recipe is None:
+            return None
+
+        recipe["id"] = str(recipe.pop("_id"))
+        data = _to_response(recipe)
+        await redis_service.write_through(
+            f"recipe:{recipe_id}",
+            data,
+            expire=settings.RECIPE_CACHE_TTL,
+            stale_ttl=settings.RECIPE_CACHE_STALE_TTL,
+        )
+
+        await self._invalidate_list_cache(*filter(None, (previous, recipe)))
+        if "ingredients" in changes:
+            await pantry_index.record_changes([(recipe_id, recipe["ingredient_ids"])])
+
+        return data
+
+    async def _replace_recipe(
+        self, recipe_id: str, changes: Dict[str, Any]
+    ) -> Tuple[Optional[dict], Optional[dict]]:
+        """
+        Полное обновление одним запросом: старая версия (только поля тегов
+        списка) приходит из find_one_and_update, новая - это сам $set
         """
         collection = await self._get_collection()
 
-        try:
-            recipe_data["updated_at"] = datetime.utcnow()
+        update = dict(changes)
+        ingredients_map = await self._get_ingredients_map([update])
+        apply_nutrition([update], ingredients_map)
+        update["ingredient_ids"] = recipe_ingredient_ids(update)
+        now = datetime.utcnow()
+        update["updated_at"] = now
 
-            await collection.update_one(
-                {"_id": ObjectId(recipe_id)},
-                {"$set": recipe_data},
-            )
+        previous = await collection.find_one_and_update(
+            {"_id": ObjectId(recipe_id)},
+            {"$set": update},
+            projection=dict.fromkeys(LIST_TAG_FIELDS + ("created_at",), 1),
+            return_document=ReturnDocument.BEFORE,
+        )
+        if not previous:
+            return None, None
 
-            # Invalidate cache
-            await redis_service.delete(f"recipe:{recipe_id}")
-            await redis_service.delete_by_pattern("recipes_list:*")
+        # У импортированных и старых документов created_at может не быть
+        recipe = {
+            **update,
+            "_id": previous["_id"],
+            "created_at": previous.get("created_at", now),
+        }
+        return previous, recipe
 
-            return await self.get_recipe(recipe_id)
+    async def _patch_recipe(
+        self, recipe_id: str, changes: Dict[str, Any]
+    ) -> Tuple[Optional[dict], Optional[dict]]:
+        """
+        Частичное обновление: новая версия приходит из find_one_and_update.
+        Текущий документ читается, только если он нужен для пересчёта КБЖУ
+        или для сброса страниц списка, в которые рецепт попадал до изменения
+        """
+        collection = await self._get_collection()
+        recalculate = not changes.keys().isdisjoint(NUTRITION_FIELDS)
 
-        except Exception:
-            return None
+        projection = None
+        if recalculate or not changes.keys().isdisjoint(LIST_TAG_FIELDS):
+            projection = dict.fromkeys(LIST_TAG_FIELDS + ("portions", "updated_at"), 1)
+            if recalculate and "ingredients" not in changes:
+                projection["ingredients"] = 1
+
+        for _ in range(UPDATE_ATTEMPTS):
+            update = dict(changes)
+            query = {"_id": ObjectId(recipe_id)}
+
+            current = None
+            if projection:
+                current = await collection.find_one(query, projection)
+                if not current:
+                    return None, None
+                # Документ не должен измениться между чтением и записью
+                query["updated_at"] = current["updated_at"]
+
+            if recalculate:
+                nutrition = {
+                    field: update.get(field, current.get(field))
+                    for field in NUTRITION_FIELDS
+                }
+                ingredients_map = await self._get_ingredients_map([nutrition])
+                apply_nutrition([nutrition], ingredients_map)
+                update.update(nutrition)
+                if "ingredients" in changes:
+                    update["ingredient_ids"] = recipe_ingredient_ids(update)
+
+            update["updated_at"] = datetime.utcnow()
+            recipe = await collection.find_one_and_update(
+                query, {"$set": update}, return_document=ReturnDocument.AFTER
+            )
+            if recipe:
+                return current, recipe
+            if current is None:
+                return None, None
+
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Recipe was modified concurrently, try again",
+        )
 
     async def delete_recipe(self, recipe_id: str) -> bool:
         """
@@ -301,11 +1031,12 @@ class RecipeService:
         collection = await self._get_collection()
 
         try:
-            result = await collection.delete_one({"_id": ObjectId(recipe_id)})
-            if result.deleted_count > 0:
+            recipe = await collection.find_one_and_delete({"_id": ObjectId(recipe_id)})
+            if recipe:
                 # Invalidate cache
                 await redis_service.delete(f"recipe:{recipe_id}")
-                await redis_service.delete_by_pattern("recipes_list:*")
+                await self._invalidate_list_cache(recipe)
+                await pantry_index.record_changes([(recipe_id, None)])
                 return True
             return False
         except Exception:
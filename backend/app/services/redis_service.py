@@ -1,43 +1,485 @@
+import asyncio
 import json
-from datetime import datetime
-from typing import Any, Optional
+import logging
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
 from redis import asyncio as aioredis
 from app.config import settings
+from app.services.local_cache import LocalCache
+from app.utils import cache_codec
 
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return super().default(obj)
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "cache_invalidation"
+
+# Паузы перед переподключением слушателя инвалидаций (удваиваются до максимума)
+LISTENER_RETRY_SECONDS = 0.5
+LISTENER_MAX_RETRY_SECONDS = 30.0
+
+# Снимаем блокировку, только если она всё ещё наша
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
 
 class RedisService:
     def __init__(self):
         self._redis: Optional[aioredis.Redis] = None
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        self._listener_task: Optional[asyncio.Task] = None
+
+        # L1: кэш в памяти процесса перед Redis
+        self._local: Optional[LocalCache] = None
+        if settings.L1_CACHE_ENABLED:
+            self._local = LocalCache(
+                max_items=settings.L1_CACHE_MAX_ITEMS,
+                max_bytes=settings.L1_CACHE_MAX_BYTES,
+                ttl=settings.L1_CACHE_TTL_SECONDS,
+            )
+        self._redis_hits = 0
+        self._redis_misses = 0
 
     async def get_redis(self) -> aioredis.Redis:
         if self._redis is None:
-            self._redis = aioredis.from_url(settings.REDIS_URL, decode_responses=True)
+            self._redis = aioredis.from_url(settings.REDIS_URL)
         return self._redis
 
-    async def set(self, key: str, value: Any, expire: int = 3600):
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Счётчики попаданий/промахов по уровням кэша
+        """
+        return {
+            "l1": self._local.stats() if self._local is not None else None,
+            "redis": {"hits": self._redis_hits, "misses": self._redis_misses},
+        }
+
+    def _fetched(
+        self, key: str, data: Optional[bytes], local_ttl: Optional[float] = None
+    ) -> Optional[bytes]:
+        """
+        Учесть ответ Redis в счётчиках и положить сырое значение в L1
+        """
+        if not data:
+            self._redis_misses += 1
+            return None
+
+        self._redis_hits += 1
+        if self._local is not None and (local_ttl is None or local_ttl > 0):
+            self._local.set(key, data, len(data), ttl=local_ttl)
+        return data
+
+    async def set(self, key: str, value: Any, expire: int = 3600) -> bytes:
+        redis = await self.get_redis()
+        data = cache_codec.encode(value)
+        await redis.set(key, data, ex=expire)
+        if self._local is not None:
+            self._local.set(key, data, len(data), ttl=expire)
+        return data
+
+    async def write_through(
+        self, key: str, value: Any, expire: int = 3600, stale_ttl: int = 0
+    ) -> bytes:
+        """
+        Записать новую версию значения поверх закэшированной вместо удаления:
+        остальные воркеры сбрасывают старую копию в L1 и читают её из Redis
+        """
+        redis = await self.get_redis()
+        data = cache_codec.encode(value)
+        await redis.set(key, data, ex=expire + stale_ttl)
+        await self._invalidate_local(keys=[key])
+        if self._local is not None:
+            self._local.set(key, data, len(data), ttl=expire)
+        return data
+
+    async def get_raw(self, key: str) -> Optional[bytes]:
+        """
+        Закодированное значение без десериализации (см. cache_codec)
+        """
+        if self._local is not None:
+            data = self._local.get(key)
+            if data is not None:
+                return data
+
+        redis = await self.get_redis()
+        return self._fetched(key, await redis.get(key))
+
+    async def get_many_raw(self, keys: List[str]) -> List[Optional[bytes]]:
+        """
+        Закодированные значения по списку ключей (в том же порядке):
+        сначала L1, остальные одним MGET
+        """
+        result: List[Optional[bytes]] = [None] * len(keys)
+        missing = []
+        for index, key in enumerate(keys):
+            data = self._local.get(key) if self._local is not None else None
+            if data is None:
+                missing.append(index)
+            else:
+                result[index] = data
+
+        if missing:
+            redis = await self.get_redis()
+            values = await redis.mget([keys[index] for index in missing])
+            for index, data in zip(missing, values):
+                result[index] = self._fetched(keys[index], data)
+        return result
+
+    async def set_many(
+        self, items: Dict[str, Any], expire: int = 3600, stale_ttl: int = 0
+    ) -> Dict[str, bytes]:
+        """
+        Записать несколько значений одним пайплайном; ключ живёт
+        expire + stale_ttl секунд, как у get_or_set
+        """
+        encoded = {key: cache_codec.encode(value) for key, value in items.items()}
+        if not encoded:
+            return encoded
+
         redis = await self.get_redis()
-        await redis.set(key, json.dumps(value, cls=DateTimeEncoder), ex=expire)
+        async with redis.pipeline(transaction=False) as pipe:
+            for key, data in encoded.items():
+                pipe.set(key, data, ex=expire + stale_ttl)
+            await pipe.execute()
+
+        if self._local is not None:
+            for key, data in encoded.items():
+                self._local.set(key, data, len(data), ttl=expire)
+        return encoded
 
     async def get(self, key: str) -> Optional[Any]:
+        data = await self.get_raw(key)
+        return cache_codec.decode(data) if data else None
+
+    async def _get_with_ttl(
+        self, key: str, stale_ttl: int
+    ) -> Tuple[Optional[bytes], bool]:
+        """
+        Значение и признак того, что оно уже в окне устаревания
+        """
+        redis = await self.get_redis()
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.pttl(key)
+            data, ttl_ms = await pipe.execute()
+
+        is_stale = bool(stale_ttl) and 0 <= ttl_ms < stale_ttl * 1000
+        # В L1 кладём только свежие значения и не дольше их свежести
+        local_ttl = ttl_ms / 1000 - stale_ttl if ttl_ms > 0 else None
+        return self._fetched(key, data, local_ttl=local_ttl), is_stale
+
+    async def _store(
+        self, key: str, value: Any, expire: int, tags: Optional[Iterable[str]]
+    ) -> bytes:
+        data = await self.set(key, value, expire=expire)
+        if tags:
+            await self.add_tags(key, tags, expire=expire)
+        return data
+
+    async def _acquire_lock(self, key: str) -> Optional[str]:
+        redis = await self.get_redis()
+        token = uuid.uuid4().hex
+        acquired = await redis.set(
+            f"lock:{key}",
+            token,
+            nx=True,
+            px=int(settings.CACHE_LOCK_TTL_SECONDS * 1000),
+        )
+        return token if acquired else None
+
+    async def _release_lock(self, key: str, token: str):
+        redis = await self.get_redis()
+        await redis.eval(RELEASE_LOCK_SCRIPT, 1, f"lock:{key}", token)
+
+    async def get_or_set(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[Any]],
+        expire: int = 3600,
+        stale_ttl: int = 0,
+        tags: Optional[Iterable[str]] = None,
+    ) -> Optional[Any]:
+        """
+        Cache-aside с single-flight: при промахе значение загружает одна
+        корутина в процессе, остальные ждут её результат.
+
+        Ключ живёт expire + stale_ttl секунд; в последние stale_ttl секунд
+        значение считается устаревшим: отдаём его сразу и обновляем в фоне.
+        """
+        data = await self.get_or_set_raw(key, loader, expire, stale_ttl, tags)
+        return cache_codec.decode(data) if data else None
+
+    async def get_or_set_raw(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[Any]],
+        expire: int = 3600,
+        stale_ttl: int = 0,
+        tags: Optional[Iterable[str]] = None,
+    ) -> Optional[bytes]:
+        """
+        То же, что get_or_set, но возвращает закодированное значение
+        """
+        if self._local is not None:
+            data = self._local.get(key)
+            if data is not None:
+                return data
+
+        data, is_stale = await self._get_with_ttl(key, stale_ttl)
+        if data is not None:
+            if is_stale:
+                self._schedule_refresh(key, loader, expire + stale_ttl, tags)
+            return data
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(
+                self._load_with_lock(key, loader, expire + stale_ttl, tags)
+            )
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        return await asyncio.shield(task)
+
+    async def _load_with_lock(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[Any]],
+        expire: int,
+        tags: Optional[Iterable[str]],
+    ) -> Optional[bytes]:
+        """
+        Между воркерами: лидер берёт короткую блокировку в Redis и пишет
+        значение, остальные ждут его записи вместо запроса в базу
+        """
+        token = await self._acquire_lock(key)
+        if token:
+            try:
+                value = await loader()
+                if value is None:
+                    return None
+                return await self._store(key, value, expire, tags)
+            finally:
+                await self._release_lock(key, token)
+
+        redis = await self.get_redis()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.CACHE_LOCK_TTL_SECONDS
+        while loop.time() < deadline:
+            await asyncio.sleep(settings.CACHE_LOCK_POLL_SECONDS)
+            data = await self.get_raw(key)
+            if data is not None:
+                return data
+            if not await redis.exists(f"lock:{key}"):
+                break
+
+        # Лидер не записал значение (ошибка или пустой результат)
+        value = await loader()
+        return cache_codec.encode(value) if value is not None else None
+
+    def _schedule_refresh(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[Any]],
+        expire: int,
+        tags: Optional[Iterable[str]],
+    ):
+        if key in self._refreshing:
+            return
+
+        task = asyncio.ensure_future(self._refresh(key, loader, expire, tags))
+        self._refreshing[key] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(key, None))
+
+    async def _refresh(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[Any]],
+        expire: int,
+        tags: Optional[Iterable[str]],
+    ):
+        """
+        Фоновое обновление устаревшего значения (только одним воркером)
+        """
+        token = await self._acquire_lock(key)
+        if not token:
+            return
+
+        try:
+            value = await loader()
+            if value is not None:
+                await self._store(key, value, expire, tags)
+        except Exception:
+            logger.exception("Cache refresh failed for %s", key)
+        finally:
+            await self._release_lock(key, token)
+
+    async def _invalidate_local(
+        self, keys: Optional[Iterable[str]] = None, pattern: Optional[str] = None
+    ):
+        """
+        Сбросить L1 в этом процессе и разослать инвалидацию остальным воркерам
+        """
+        if self._local is None:
+            return
+
+        keys = list(keys or [])
+        self._local.delete(keys)
+        if pattern:
+            self._local.delete_by_pattern(pattern)
+
+        redis = await self.get_redis()
+        await redis.publish(
+            INVALIDATION_CHANNEL, json.dumps({"keys": keys, "pattern": pattern})
+        )
+
+    async def _listen_invalidations(self):
+        """
+        Подписка на инвалидации L1 от других воркеров. Пока подписки нет,
+        L1 мог устареть, поэтому при каждом (пере)подключении он очищается;
+        при ошибке слушатель переподключается с растущей паузой
+        """
+        delay = LISTENER_RETRY_SECONDS
+        while True:
+            try:
+                redis = await self.get_redis()
+                pubsub = redis.pubsub()
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Пока не были подписаны, сообщения могли потеряться
+                self._local.clear()
+                delay = LISTENER_RETRY_SECONDS
+                try:
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        data = json.loads(message["data"])
+                        self._local.delete(data.get("keys") or [])
+                        if data.get("pattern"):
+                            self._local.delete_by_pattern(data["pattern"])
+                finally:
+                    await pubsub.aclose()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(
+                    "Cache invalidation listener failed, reconnecting in %.1fs", delay
+                )
+                # Без подписки L1 не знает об изменениях - не отдаём из него
+                self._local.clear()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, LISTENER_MAX_RETRY_SECONDS)
+
+    def _on_listener_done(self, task: asyncio.Task):
+        """
+        Слушатель не должен завершаться сам: если это случилось (не отмена),
+        запускаем его заново
+        """
+        if task.cancelled() or task is not self._listener_task:
+            return
+        if task.exception() is not None:
+            logger.error(
+                "Cache invalidation listener stopped", exc_info=task.exception()
+            )
+        self._local.clear()
+        self._start_listener()
+
+    def _start_listener(self):
+        self._listener_task = asyncio.create_task(self._listen_invalidations())
+        self._listener_task.add_done_callback(self._on_listener_done)
+
+    async def start_invalidation_listener(self):
+        if self._local is not None and self._listener_task is None:
+            self._start_listener()
+
+    async def stop_invalidation_listener(self):
+        if self._listener_task:
+            self._listener_task.cancel()
+            try:
+                await self._listener_task
+            except asyncio.CancelledError:
+                pass
+            self._listener_task = None
+
+    async def delete(self, *keys: str):
+        if not keys:
+            return
         redis = await self.get_redis()
-        data = await redis.get(key)
-        if data:
-            return json.loads(data)
-        return None
+        await redis.delete(*keys)
+        await self._invalidate_local(keys=list(keys))
 
-    async def delete(self, key: str):
+    async def delete_by_pattern(self, pattern: str, batch_size: int = 500):
+        """
+        Удаление ключей по шаблону через SCAN (не блокирует Redis как KEYS)
+        """
         redis = await self.get_redis()
-        await redis.delete(key)
+        keys = []
+        async for key in redis.scan_iter(match=pattern, count=batch_size):
+            keys.append(key)
+            if len(keys) >= batch_size:
+                await redis.unlink(*keys)
+                keys = []
+        if keys:
+            await redis.unlink(*keys)
+        await self._invalidate_local(pattern=pattern)
 
-    async def delete_by_pattern(self, pattern: str):
+    async def add_tags(self, key: str, tags: Iterable[str], expire: int = 3600):
+        """
+        Привязать ключ к тегам (множества тегов живут не меньше самого ключа)
+        """
         redis = await self.get_redis()
-        keys = await redis.keys(pattern)
+        async with redis.pipeline(transaction=False) as pipe:
+            for tag in tags:
+                pipe.sadd(tag, key)
+                pipe.expire(tag, expire)
+            await pipe.execute()
+
+    async def delete_by_tags(self, tag_groups: Iterable[Iterable[str]]):
+        """
+        Удалить ключи, которые есть хотя бы в одном теге каждой группы
+        (теги внутри группы объединяются, группы пересекаются)
+        """
+        groups = [list(group) for group in tag_groups]
+        if not groups:
+            return
+
+        redis = await self.get_redis()
+        async with redis.pipeline(transaction=False) as pipe:
+            for group in groups:
+                pipe.sunion(*group)
+            members = await pipe.execute()
+
+        keys = set.intersection(
+            *({key.decode() for key in group_keys} for group_keys in members)
+        )
         if keys:
-            await redis.delete(*keys)
+            await redis.unlink(*keys)
+            await self._invalidate_local(keys=keys)
+
+    async def get_namespace_version(self, namespace: str, local: bool = True) -> int:
+        version_key = f"namespace:{namespace}:version"
+        if local and self._local is not None:
+            version = self._local.get(version_key)
+            if version is not None:
+                return version
+
+        redis = await self.get_redis()
+        version = await redis.get(version_key)
+        version = int(version) if version else 0
+        if self._local is not None:
+            self._local.set(version_key, version, len(version_key))
+        return version
+
+    async def bump_namespace(self, namespace: str) -> int:
+        """
+        Инвалидация всего пространства ключей одним INCR:
+        старые ключи больше не читаются и истекают по TTL
+        """
+        redis = await self.get_redis()
+        version_key = f"namespace:{namespace}:version"
+        version = await redis.incr(version_key)
+        await self._invalidate_local(keys=[version_key])
+        return version
 
 redis_service = RedisService()
@@ -0,0 +1,425 @@
+import asyncio
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from app.config import settings
+from app.models.tortoise.substitute import Substitute
+from app.services.ingredient_catalog import ingredient_catalog
+from app.services.redis_service import redis_service
+from app.utils.nutrition import macro_matrix
+
+SUBSTITUTES_NAMESPACE = "substitutes"
+
+MACRO_FIELDS = (
+    "calories_per_100g",
+    "protein_per_100g",
+    "fat_per_100g",
+    "carbs_per_100g",
+)
+
+# Критерии выбора замены: closest - ближе всего по БЖУ к оригиналу,
+# остальные - по КБЖУ самой замены с учётом коэффициента
+SUBSTITUTE_PREFERENCES = (
+    "closest",
+    "low_calorie",
+    "high_protein",
+    "low_fat",
+    "low_carb",
+)
+
+# Граф замен: ингредиент -> [(замена, коэффициент)] в порядке ранжирования
+Graph = Dict[int, List[Tuple[int, float]]]
+
+
+def _shortest_paths(graph: Graph, max_depth: int) -> Graph:
+    """
+    Все ингредиенты, достижимые не более чем за max_depth замен, в порядке
+    (число шагов, ранг на каждом шаге); коэффициенты вдоль пути перемножаются
+    """
+    paths = {}
+    for origin in graph:
+        reached = []
+        seen = {origin}
+        frontier = [(origin, 1.0)]
+        for _ in range(max_depth):
+            next_frontier = []
+            for node, coefficient in frontier:
+                for target, step in graph.get(node, ()):
+                    if target not in seen:
+                        seen.add(target)
+                        next_frontier.append((target, coefficient * step))
+            reached.extend(next_frontier)
+            frontier = next_frontier
+        paths[origin] = reached
+    return paths
+
+
+class SubstituteIndex:
+    """
+    Ранжированные замены ингредиентов в памяти процесса.
+
+    Для каждой строки таблицы замен векторно считается КБЖУ замены с учётом
+    коэффициента и расстояние по БЖУ до оригинала, затем для каждого
+    критерия строки сортируются по (оригинал, оценка, id). Замены одного
+    ингредиента лежат подряд, поэтому поиск - это срез по диапазону.
+
+    Строки замен и КБЖУ ингредиентов обновляются независимо. КБЖУ берутся
+    из снимка справочника ингредиентов в памяти: при его новой версии
+    пересортировываются только замены ингредиентов, у которых (или у
+    замен которых) изменилось КБЖУ.
+
+    Поверх ранжирования строится граф замен с кратчайшими путями ограниченной
+    глубины (A -> B -> C, коэффициенты перемножаются): если прямая замена тоже
+    недоступна, берётся следующая по пути. Граф пересобирается в фоновом
+    потоке, запросы ждут его только через ensure_current().
+    """
+
+    def __init__(self) -> None:
+        self._rows: Dict[str, np.ndarray] = {}
+        self._macro_ids = np.zeros(0, dtype=np.int64)
+        self._macros = np.zeros((0, len(MACRO_FIELDS)), dtype=np.float64)
+        self._orders: Dict[str, np.ndarray] = {}
+        self._spans: Dict[int, Tuple[int, int]] = {}
+        self._paths: Dict[str, Graph] = {}
+        self._versions: Optional[Tuple[int, int]] = None
+        self._rebuild_task: Optional[asyncio.Task] = None
+        self._loaded = False
+        self._lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._loaded
+
+    def ranked(
+        self, ingredient_id: int, preference: str = "closest"
+    ) -> List[Dict[str, Any]]:
+        """
+        Замены ингредиента от лучшей к худшей по выбранному критерию
+        """
+        span = self._spans.get(ingredient_id)
+        if span is None:
+            return []
+
+        rows = self._orders[preference][span[0] : span[1]]
+        return [
+            {
+                "original_ingredient_id": ingredient_id,
+                "substitute_ingredient_id": int(self._rows["substitute"][row]),
+                "coefficient": float(self._rows["coefficient"][row]),
+            }
+            for row in rows
+        ]
+
+    def best(
+        self, ingredient_id: int, preference: str = "closest"
+    ) -> Optional[Dict[str, Any]]:
+        ranked = self.ranked(ingredient_id, preference)
+        return ranked[0] if ranked else None
+
+    def resolve(
+        self,
+        ingredient_id: int,
+        unavailable_ids: Iterable[int] = (),
+        preference: str = "closest",
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Ближайшая доступная замена с учётом цепочек замен
+        """
+        unavailable_ids = set(unavailable_ids)
+        for target, coefficient in self._paths.get(preference, {}).get(
+            ingredient_id, ()
+        ):
+            if target not in unavailable_ids:
+                return {
+                    "original_ingredient_id": ingredient_id,
+                    "substitute_ingredient_id": target,
+                    "coefficient": coefficient,
+                }
+        return None
+
+    def reachable(
+        self, ingredient_ids: Iterable[int], preference: str = "closest"
+    ) -> Set[int]:
+        """
+        Ингредиенты, которые могут оказаться на пути замены ingredient_ids
+        """
+        paths = self._paths.get(preference, {})
+        return {
+            target
+            for ingredient_id in ingredient_ids
+            for target, _ in paths.get(ingredient_id, ())
+        }
+
+    def substitutable(self, available_ids: Iterable[int]) -> Set[int]:
+        """
+        Ингредиенты, для которых среди available_ids есть прямая замена
+        """
+        if not self._rows:
+            return set()
+        available = np.fromiter(set(available_ids), dtype=np.int64)
+        matched = np.isin(self._rows["substitute"], available)
+        return set(self._rows["original"][matched].tolist())
+
+    @property
+    def versions(self) -> Optional[Tuple[int, int]]:
+        return self._versions
+
+    async def _fetch_versions(self) -> Tuple[int, int]:
+        """
+        Версия замен (из L1, её сбрасывает инвалидация по pub/sub) и версия
+        снимка справочника ингредиентов, из которого берутся КБЖУ
+        """
+        await ingredient_catalog.ensure_loaded()
+        return (
+            await redis_service.get_namespace_version(SUBSTITUTES_NAMESPACE),
+            ingredient_catalog.version,
+        )
+
+    async def _load_rows(self):
+        rows = await Substitute.all().values_list(
+            "id", "original_ingredient_id", "substitute_ingredient_id", "coefficient"
+        )
+        columns = np.array(rows, dtype=np.float64).reshape(-1, 4)
+        self._rows = {
+            "id": columns[:, 0].astype(np.int64),
+            "original": columns[:, 1].astype(np.int64),
+            "substitute": columns[:, 2].astype(np.int64),
+            "coefficient": columns[:, 3],
+        }
+
+    def _catalog_macros(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        КБЖУ ингредиентов, участвующих в заменах, из снимка справочника
+        """
+        ids = np.union1d(self._rows["original"], self._rows["substitute"])
+        return macro_matrix(ingredient_catalog.get_many(ids.tolist()))
+
+    def _lookup_macros(
+        self, ingredient_ids: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        КБЖУ по массиву ID и маска ID, которые есть в справочнике
+        """
+        if not len(self._macro_ids):
+            return (
+                np.zeros((len(ingredient_ids), len(MACRO_FIELDS))),
+                np.zeros(len(ingredient_ids), dtype=bool),
+            )
+
+        positions = np.searchsorted(self._macro_ids, ingredient_ids)
+        positions = np.minimum(positions, len(self._macro_ids) - 1)
+        found = self._macro_ids[positions] == ingredient_ids
+        return self._macros[positions], found
+
+    def _order(self, rows: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Порядок строк rows для каждого критерия: по (оригинал, оценка, id)
+        """
+        original = self._rows["original"][rows]
+        original_macros, _ = self._lookup_macros(original)
+        substitute_macros, _ = self._lookup_macros(self._rows["substitute"][rows])
+        # КБЖУ замены в количестве, которым заменяется 100 г оригинала
+        substitute_macros = substitute_macros * self._rows["coefficient"][rows, None]
+        distance = np.sqrt(
+            ((substitute_macros[:, 1:] - original_macros[:, 1:]) ** 2).sum(axis=1)
+        )
+        scores = {
+            "closest": distance,
+            "low_calorie": substitute_macros[:, 0],
+            "high_protein": -substitute_macros[:, 1],
+            "low_fat": substitute_macros[:, 2],
+            "low_carb": substitute_macros[:, 3],
+        }
+
+        row_ids = self._rows["id"][rows]
+        return {
+            # lexsort сортирует по последнему ключу первым
+            preference: rows[
+                np.lexsort((row_ids, distance, scores[preference], original))
+            ]
+            for preference in SUBSTITUTE_PREFERENCES
+        }
+
+    def _rank(self):
+        """
+        Пересчитать порядок замен для всех критериев одним проходом NumPy
+        """
+        _, original_found = self._lookup_macros(self._rows["original"])
+        _, substitute_found = self._lookup_macros(self._rows["substitute"])
+        valid = np.flatnonzero(original_found & substitute_found)
+
+        grouped = np.sort(self._rows["original"][valid])
+        ingredient_ids, starts, counts = np.unique(
+            grouped, return_index=True, return_counts=True
+        )
+        self._orders = self._order(valid)
+        self._spans = {
+            int(ingredient_id): (int(start), int(start + count))
+            for ingredient_id, start, count in zip(ingredient_ids, starts, counts)
+        }
+
+    def _rerank(self, ingredient_ids: np.ndarray) -> bool:
+        """
+        Пересортировать замены только указанных ингредиентов; возвращает,
+        изменился ли порядок хоть у одного из них
+        """
+        spans = [
+            self._spans[ingredient_id]
+            for ingredient_id in sorted(set(ingredient_ids.tolist()))
+            if ingredient_id in self._spans
+        ]
+        if not spans:
+            return False
+
+        # Диапазоны идут по возрастанию оригинала - в том же порядке, в каком
+        # _order группирует строки, поэтому результат ложится на них как есть
+        positions = np.concatenate([np.arange(start, end) for start, end in spans])
+        rows = self._orders[SUBSTITUTE_PREFERENCES[0]][positions]
+
+        changed = False
+        for preference, order in self._order(rows).items():
+            if not np.array_equal(self._orders[preference][positions], order):
+                self._orders[preference][positions] = order
+                changed = True
+        return changed
+
+    def _update_macros(self) -> bool:
+        """
+        Подхватить новую версию справочника; возвращает, изменилось ли
+        ранжирование
+        """
+        ids, macros = self._catalog_macros()
+        if not np.array_equal(ids, self._macro_ids):
+            # Ингредиент удалён или появился - меняется состав строк
+            self._macro_ids, self._macros = ids, macros
+            self._rank()
+            return True
+
+        changed_ids = ids[(macros != self._macros).any(axis=1)]
+        if not len(changed_ids):
+            return False
+
+        self._macros = macros
+        rows = self._rows
+        touched = np.isin(rows["original"], changed_ids) | np.isin(
+            rows["substitute"], changed_ids
+        )
+        return self._rerank(rows["original"][touched])
+
+    async def sync(self):
+        """
+        Перечитать то, что изменилось: строки замен и/или КБЖУ ингредиентов
+
+        Если версии не изменились, выходим без блокировки и без запросов
+        """
+        versions = await self._fetch_versions()
+        if versions == self._versions:
+            return
+
+        async with self._lock:
+            versions = await self._fetch_versions()
+            if versions == self._versions:
+                return
+
+            if self._versions is None or versions[0] != self._versions[0]:
+                await self._load_rows()
+                self._macro_ids, self._macros = self._catalog_macros()
+                self._rank()
+                changed = True
+            else:
+                changed = self._update_macros()
+
+            self._versions = versions
+            self._loaded = True
+            if changed:
+                self._schedule_rebuild()
+
+    def _graph(self, preference: str) -> Graph:
+        return {
+            ingredient_id: [
+                (substitute["substitute_ingredient_id"], substitute["coefficient"])
+                for substitute in self.ranked(ingredient_id, preference)
+            ]
+            for ingredient_id in self._spans
+        }
+
+    def _schedule_rebuild(self):
+        """
+        Пересобрать пути в фоновом потоке; более старая сборка отменяется
+        """
+        if self._rebuild_task and not self._rebuild_task.done():
+            self._rebuild_task.cancel()
+
+        graphs = {
+            preference: self._graph(preference)
+            for preference in SUBSTITUTE_PREFERENCES
+        }
+        self._rebuild_task = asyncio.create_task(self._rebuild(graphs))
+
+    async def _rebuild(self, graphs: Dict[str, Graph]):
+        paths = {}
+        for preference, graph in graphs.items():
+            paths[preference] = await asyncio.to_thread(
+                _shortest_paths, graph, settings.SUBSTITUTE_MAX_DEPTH
+            )
+        self._paths = paths
+
+    async def ensure_loaded(self):
+        if not self._loaded:
+            await self.sync()
+
+    async def ensure_current(self) -> Tuple[int, int]:
+        """
+        Догнать версии в Redis и дождаться сборки путей; возвращает версии,
+        по которым построен индекс (их можно класть в ключи кэша)
+        """
+        await self.sync()
+        task = self._rebuild_task
+        while task is not None and not task.done():
+            try:
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                # Сборку заменила более новая - ждём её
+                if asyncio.current_task().cancelling():
+                    raise
+            task = self._rebuild_task
+        return self._versions
+
+    async def refresh(self):
+        """
+        Подхватить изменение сразу в этом процессе (остальные - в фоне)
+        """
+        if self._loaded:
+            await self.sync()
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(settings.SUBSTITUTE_INDEX_REFRESH_SECONDS)
+            try:
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Substitute index refresh failed: {e}")
+
+    async def start(self):
+        await self.sync()
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+        print(f"✅ Substitute index loaded - {len(self._rows['id'])} substitutes")
+
+    async def stop(self):
+        if self._rebuild_task:
+            self._rebuild_task.cancel()
+            self._rebuild_task = None
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+
+
+substitute_index = SubstituteIndex()
@@ -0,0 +1,104 @@
+import json
+import zlib
+from datetime import datetime
+from typing import Any
+
+import orjson
+
+from app.config import settings
+
+try:
+    import msgpack
+except ImportError:  # msgpack - необязательная зависимость
+    msgpack = None
+
+# Первый байт значения в кэше: младшие биты - кодек, старший бит - сжатие.
+# Старые значения (обычный JSON-текст) заголовка не имеют и начинаются
+# с печатного символа, поэтому оба формата читаются одновременно.
+CODEC_JSON = 0x01
+CODEC_MSGPACK = 0x02
+COMPRESSED = 0x80
+CODEC_MASK = 0x7F
+
+COMPRESSION_LEVEL = 1
+
+CODECS = {"json": CODEC_JSON, "msgpack": CODEC_MSGPACK}
+
+
+def _codec(name: str) -> int:
+    """
+    Заголовок кодека по имени из CACHE_CODEC; недоступный кодек - ошибка
+    конфигурации, а не тихий переход на JSON
+    """
+    if name not in CODECS:
+        raise ValueError(f"Unknown CACHE_CODEC {name!r}, expected one of {sorted(CODECS)}")
+    if name == "msgpack" and msgpack is None:
+        raise RuntimeError(
+            "CACHE_CODEC=msgpack requires the msgpack package (install the msgpack extra)"
+        )
+    return CODECS[name]
+
+
+# Ошибка в настройках должна остановить запуск, а не проявиться при первой записи
+_codec(settings.CACHE_CODEC)
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+def encode(value: Any) -> bytes:
+    """
+    Сериализовать значение для Redis выбранным кодеком (CACHE_CODEC)
+    """
+    header = _codec(settings.CACHE_CODEC)
+    if header == CODEC_MSGPACK:
+        payload = msgpack.packb(value, default=_default)
+    else:
+        payload = orjson.dumps(value)
+
+    threshold = settings.CACHE_COMPRESS_THRESHOLD
+    if threshold and len(payload) >= threshold:
+        header |= COMPRESSED
+        payload = zlib.compress(payload, COMPRESSION_LEVEL)
+
+    return bytes((header,)) + payload
+
+
+def decode(data: bytes) -> Any:
+    """
+    Десериализовать значение из Redis (новый формат с заголовком или старый JSON)
+    """
+    header = data[0]
+    if 0x20 <= header < COMPRESSED:
+        return json.loads(data)
+
+    payload = data[1:]
+    if header & COMPRESSED:
+        payload = zlib.decompress(payload)
+
+    codec = header & CODEC_MASK
+    if codec == CODEC_MSGPACK:
+        if msgpack is None:
+            raise RuntimeError("msgpack is required to decode this cache entry")
+        return msgpack.unpackb(payload)
+    return orjson.loads(payload)
+
+
+def to_json(data: bytes) -> bytes:
+    """
+    JSON-представление закодированного значения (без разбора, если это JSON)
+    """
+    header = data[0]
+    if 0x20 <= header < COMPRESSED:
+        return data
+
+    payload = data[1:]
+    if header & COMPRESSED:
+        payload = zlib.decompress(payload)
+
+    if header & CODEC_MASK == CODEC_JSON:
+        return payload
+    return orjson.dumps(decode(data))
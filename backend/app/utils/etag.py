@@ -0,0 +1,53 @@
+from hashlib import blake2b
+from typing import Optional
+
+from fastapi import Response, status
+
+# Ответы зависят от токена, поэтому кэшировать их может только клиент,
+# и каждый раз он должен перепроверять версию через If-None-Match
+CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(body: bytes) -> str:
+    """
+    Сильный ETag по содержимому тела ответа
+    """
+    return f'"{blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def not_modified(etag: str) -> Response:
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED,
+        headers={"ETag": etag, "Cache-Control": CACHE_CONTROL},
+    )
+
+
+def json_response(body: bytes, if_none_match: Optional[str]) -> Response:
+    """
+    Готовое JSON-тело с ETag или 304, если версия у клиента совпадает
+    """
+    etag = make_etag(body)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={"ETag": etag, "Cache-Control": CACHE_CONTROL},
+    )
+
+
+def set_etag(response: Response, etag: str):
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CACHE_CONTROL
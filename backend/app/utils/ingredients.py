@@ -0,0 +1,8 @@
+from typing import Any, Dict, List
+
+
+def recipe_ingredient_ids(recipe: Dict[str, Any]) -> List[int]:
+    """
+    Денормализованный массив ID ингредиентов рецепта (под multikey индекс)
+    """
+    return sorted({ingredient["ingredient_id"] for ingredient in recipe["ingredients"]})
@@ -0,0 +1,105 @@
+from typing import Any, Dict, List, Mapping, Tuple
+
+import numpy as np
+
+# Порядок столбцов во всех матрицах КБЖУ
+MACROS = ("calories", "protein", "fat", "carbs")
+PER_100G_FIELDS = tuple(f"{macro}_per_100g" for macro in MACROS)
+
+PRECISION = 2
+
+
+def macro_matrix(
+    ingredients_map: Mapping[int, Mapping[str, Any]],
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Отсортированные ID ингредиентов и матрица их КБЖУ на 100 г (n x 4)
+    """
+    ids = np.array(sorted(ingredients_map), dtype=np.int64)
+    matrix = np.array(
+        [
+            [ingredients_map[ingredient_id][field] for field in PER_100G_FIELDS]
+            for ingredient_id in ids.tolist()
+        ],
+        dtype=np.float64,
+    ).reshape(-1, len(MACROS))
+    return ids, matrix
+
+
+def calculate(
+    ingredient_ids: np.ndarray,
+    quantities: np.ndarray,
+    recipe_index: np.ndarray,
+    portions: np.ndarray,
+    ids: np.ndarray,
+    matrix: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    КБЖУ строк, итог и на порцию для пачки рецептов
+
+    Строки всех рецептов идут подряд, recipe_index - номер рецепта строки.
+    Возвращает (строки n_lines x 4, итоги n_recipes x 4, на порцию n_recipes x 4)
+    без округления.
+    """
+    positions = np.searchsorted(ids, ingredient_ids)
+    positions = np.minimum(positions, max(len(ids) - 1, 0))
+    if not len(ids) or not np.array_equal(ids[positions], ingredient_ids):
+        missing = sorted(set(ingredient_ids.tolist()) - set(ids.tolist()))
+        raise KeyError(f"No macros for ingredients {missing}")
+
+    if (portions <= 0).any():
+        raise ValueError("Portions must be positive")
+
+    lines = matrix[positions] * (quantities / 100)[:, None]
+    totals = np.column_stack(
+        [
+            np.bincount(recipe_index, weights=lines[:, column], minlength=len(portions))
+            for column in range(len(MACROS))
+        ]
+    ).reshape(-1, len(MACROS))
+    per_portion = totals / portions[:, None]
+    return lines, totals, per_portion
+
+
+def apply_nutrition(
+    recipes: List[Dict[str, Any]], ingredients_map: Mapping[int, Mapping[str, Any]]
+) -> None:
+    """
+    Посчитать и записать в рецепты КБЖУ ингредиентов, итог и на порцию
+
+    Работает одинаково для одного рецепта и для пачки из тысяч: все строки
+    считаются одной операцией NumPy.
+    """
+    if not recipes:
+        return
+
+    lines = [ingredient for recipe in recipes for ingredient in recipe["ingredients"]]
+    recipe_index = np.repeat(
+        np.arange(len(recipes)), [len(recipe["ingredients"]) for recipe in recipes]
+    )
+    ingredient_ids = np.array(
+        [line["ingredient_id"] for line in lines], dtype=np.int64
+    )
+    quantities = np.array([line["quantity"] for line in lines], dtype=np.float64)
+    portions = np.array([recipe["portions"] for recipe in recipes], dtype=np.float64)
+
+    line_macros, totals, per_portion = calculate(
+        ingredient_ids,
+        quantities,
+        recipe_index,
+        portions,
+        *macro_matrix(ingredients_map),
+    )
+
+    for line, values in zip(lines, np.round(line_macros, PRECISION).tolist()):
+        line.update(zip(MACROS, values))
+
+    for recipe, total, portion in zip(
+        recipes,
+        np.round(totals, PRECISION).tolist(),
+        np.round(per_portion, PRECISION).tolist(),
+    ):
+        for macro, value in zip(MACROS, total):
+            recipe[f"total_{macro}"] = value
+        for macro, value in zip(MACROS, portion):
+            recipe[f"{macro}_per_portion"] = value
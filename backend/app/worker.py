@@ -6,6 +6,10 @@ from motor.motor_asyncio import AsyncIOMotorDatabase
 
 from app.config import settings
 from app.db.mongodb import close_mongodb, get_mongodb, init_mongodb
+from app.db.tortoise_config import close_tortoise, init_tortoise
+from app.services.recipe_service import RecipeService
+
+recipe_service = RecipeService()
 
 
 async def process_task(message: aio_pika.IncomingMessage):
@@ -27,11 +31,17 @@ async def process_task(message: aio_pika.IncomingMessage):
             )
             print(f" [x] Updated {result.modified_count} prices")
 
+        elif task_type == "recalculate_nutrition":
+            # Пересчёт КБЖУ рецептов после изменения ингредиента
+            updated = await recipe_service.recalculate_nutrition(data["ingredient_id"])
+            print(f" [x] Recalculated nutrition for {updated} recipes")
+
         await asyncio.sleep(2)
         print(f" [x] Task {task_type} completed")
 
 
 async def main():
+    await init_tortoise()
     await init_mongodb()
 
     connection = await aio_pika.connect_robust(settings.RABBITMQ_URL)
@@ -49,6 +59,7 @@ async def main():
     finally:
         await connection.close()
         await close_mongodb()
+        await close_tortoise()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,77 @@
+import argparse
+import asyncio
+
+from pymongo import UpdateOne
+
+from app.db.indexes import ensure_indexes
+from app.db.mongodb import close_mongodb, get_mongodb, init_mongodb
+from app.services.pantry_index import pantry_index
+from app.services.recipe_service import RECIPES_LIST_NAMESPACE
+from app.services.redis_service import redis_service
+from app.utils.ingredients import recipe_ingredient_ids
+
+
+async def backfill(batch_size: int, rebuild: bool) -> int:
+    """
+    Заполнить ingredient_ids у рецептов, созданных до денормализации
+    """
+    db = await get_mongodb()
+    query = {} if rebuild else {"ingredient_ids": {"$exists": False}}
+
+    updated = 0
+    batch = []
+    cursor = db.recipes.find(
+        query, {"ingredients.ingredient_id": 1}, batch_size=batch_size
+    )
+    async for recipe in cursor:
+        batch.append(
+            UpdateOne(
+                {"_id": recipe["_id"]},
+                {"$set": {"ingredient_ids": recipe_ingredient_ids(recipe)}},
+            )
+        )
+        if len(batch) >= batch_size:
+            result = await db.recipes.bulk_write(batch, ordered=False)
+            updated += result.modified_count
+            batch = []
+            print(f"   ✅ Обновлено {updated} рецептов")
+
+    if batch:
+        result = await db.recipes.bulk_write(batch, ordered=False)
+        updated += result.modified_count
+
+    return updated
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Backfill ingredient_ids для фильтров по ингредиентам"
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="пересчитать ingredient_ids у всех рецептов, а не только у старых",
+    )
+    args = parser.parse_args()
+
+    await init_mongodb()
+    db = await get_mongodb()
+
+    print("🚀 Заполняем ingredient_ids...")
+    updated = await backfill(args.batch_size, args.rebuild)
+    print(f"✨ Готово, обновлено {updated} рецептов")
+
+    await ensure_indexes(db)
+
+    # Закэшированные страницы списка посчитаны со старым фильтром
+    await redis_service.bump_namespace(RECIPES_LIST_NAMESPACE)
+    # Журнал индекса кладовой не вместит весь backfill - воркеры один раз
+    # перечитают индекс целиком
+    await pantry_index.invalidate()
+
+    await close_mongodb()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,41 @@
+import argparse
+import asyncio
+
+from app.db.indexes import apply_indexes, diff_indexes
+from app.db.mongodb import close_mongodb, get_mongodb, init_mongodb
+
+
+def print_diff(diff: dict):
+    for collection_name, collection_diff in diff.items():
+        print(f"📦 {collection_name}")
+        for kind in ("missing", "changed", "extra"):
+            for name in collection_diff[kind]:
+                print(f"   {kind}: {name}")
+        if not any(collection_diff.values()):
+            print("   ✅ up to date")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Индексы MongoDB из реестра")
+    parser.add_argument("command", choices=["diff", "apply"])
+    parser.add_argument(
+        "--drop-extra",
+        action="store_true",
+        help="удалить индексы, которых нет в реестре",
+    )
+    args = parser.parse_args()
+
+    await init_mongodb()
+    db = await get_mongodb()
+
+    if args.command == "diff":
+        print_diff(await diff_indexes(db))
+    else:
+        print_diff(await apply_indexes(db, drop_extra=args.drop_extra))
+        print("✨ Индексы применены")
+
+    await close_mongodb()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
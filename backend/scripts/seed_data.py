@@ -1511,8 +1511,7 @@ async def seed_data():
         },
     ]
 
-    for r_data in recipes_list:
-        await recipe_service.create_recipe(r_data)
+    await recipe_service.create_recipes(recipes_list)
     print(f"✅ {len(recipes_list)} рецептов создано")
 
     await close_tortoise()
@@ -16,6 +16,7 @@ async def test_get_stats_admin(admin_client):
     response = await admin_client.get("/api/v1/admin/stats")
     assert response.status_code == 200
     assert response.json()["status"] == "success"
+    assert "redis" in response.json()["cache"]
 
 @pytest.mark.asyncio
 async def test_get_stats_user_forbidden(user_client):
@@ -0,0 +1,71 @@
+import json
+from datetime import datetime
+
+import pytest
+
+from app.config import settings
+from app.utils import cache_codec
+
+RECIPE = {
+    "id": "65f000000000000000000001",
+    "name": "Pasta",
+    "ingredients": [{"ingredient_id": i, "quantity": 100.5} for i in range(30)],
+    "created_at": datetime(2024, 1, 2, 3, 4, 5),
+}
+EXPECTED = {**RECIPE, "created_at": "2024-01-02T03:04:05"}
+
+
+def test_json_round_trip_with_header(monkeypatch):
+    monkeypatch.setattr(settings, "CACHE_CODEC", "json")
+    monkeypatch.setattr(settings, "CACHE_COMPRESS_THRESHOLD", 0)
+
+    data = cache_codec.encode(RECIPE)
+    assert data[0] == cache_codec.CODEC_JSON
+    assert cache_codec.decode(data) == EXPECTED
+    assert json.loads(cache_codec.to_json(data)) == EXPECTED
+
+
+def test_legacy_json_values_are_readable():
+    # Значения, записанные до появления заголовка - обычный JSON-текст
+    legacy = json.dumps(EXPECTED).encode()
+    assert cache_codec.decode(legacy) == EXPECTED
+    assert cache_codec.to_json(legacy) is legacy
+
+    assert cache_codec.decode(b"[1, 2]") == [1, 2]
+
+
+def test_compression_round_trip(monkeypatch):
+    monkeypatch.setattr(settings, "CACHE_CODEC", "json")
+    monkeypatch.setattr(settings, "CACHE_COMPRESS_THRESHOLD", 64)
+
+    data = cache_codec.encode(RECIPE)
+    assert data[0] == cache_codec.CODEC_JSON | cache_codec.COMPRESSED
+    assert len(data) < len(json.dumps(EXPECTED))
+    assert cache_codec.decode(data) == EXPECTED
+    assert json.loads(cache_codec.to_json(data)) == EXPECTED
+
+    # Короткие значения не сжимаются
+    assert cache_codec.encode({"a": 1})[0] == cache_codec.CODEC_JSON
+
+
+def test_msgpack_round_trip(monkeypatch):
+    pytest.importorskip("msgpack")
+    monkeypatch.setattr(settings, "CACHE_CODEC", "msgpack")
+    monkeypatch.setattr(settings, "CACHE_COMPRESS_THRESHOLD", 64)
+
+    data = cache_codec.encode(RECIPE)
+    assert data[0] & cache_codec.CODEC_MASK == cache_codec.CODEC_MSGPACK
+    assert cache_codec.decode(data) == EXPECTED
+    # Тело ответа из msgpack собирается через JSON
+    assert json.loads(cache_codec.to_json(data)) == EXPECTED
+
+
+def test_unavailable_codec_is_an_error(monkeypatch):
+    monkeypatch.setattr(cache_codec, "msgpack", None)
+    monkeypatch.setattr(settings, "CACHE_CODEC", "msgpack")
+    with pytest.raises(RuntimeError):
+        cache_codec.encode(RECIPE)
+
+    monkeypatch.setattr(settings, "CACHE_CODEC", "pickle")
+    with pytest.raises(ValueError):
+        cache_codec.encode(RECIPE)
@@ -57,3 +57,29 @@ async def test_delete_category_user_forbidden(user_client, admin_client):
 
     response = await user_client.delete(f"/api/v1/category/{category_id}")
     assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_get_categories_not_modified(client, admin_client):
+    await admin_client.post("/api/v1/category", json={"name": "Breakfast"})
+
+    response = await client.get("/api/v1/category")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+
+    response = await client.get("/api/v1/category", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    await admin_client.post("/api/v1/category", json={"name": "Lunch"})
+    response = await client.get("/api/v1/category", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["total"] == 2
+
+    # Запись в обход сервиса (как в scripts/seed_data.py) тоже меняет ETag
+    from app.models.tortoise.category import Category
+
+    etag = response.headers["etag"]
+    await Category.create(name="Dinner")
+    response = await client.get("/api/v1/category", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["total"] == 3
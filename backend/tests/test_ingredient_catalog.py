@@ -0,0 +1,77 @@
+import pytest
+
+from app.models.tortoise.ingredient import Ingredient
+from app.services.ingredient_catalog import CATALOG_NAMESPACE, ingredient_catalog
+from app.services.redis_service import redis_service
+
+
+@pytest.fixture
+async def ingredient(admin_client):
+    category_res = await admin_client.post(
+        "/api/v1/category", json={"name": "Test Category"}
+    )
+    payload = {
+        "name": "Milk",
+        "calories_per_100g": 42,
+        "protein_per_100g": 3.4,
+        "fat_per_100g": 1.0,
+        "carbs_per_100g": 5.0,
+        "category_id": category_res.json()["id"],
+    }
+    response = await admin_client.post("/api/v1/ingredients", json=payload)
+    return {**payload, "id": response.json()["id"]}
+
+
+@pytest.fixture
+async def catalog():
+    await ingredient_catalog.load()
+    yield ingredient_catalog
+    # Остальные тесты читают ингредиенты из базы
+    ingredient_catalog.__init__()
+
+
+@pytest.mark.asyncio
+async def test_catalog_serves_reads_from_snapshot(
+    user_client, ingredient, catalog
+):
+    # Изменение в обход сервиса не видно, пока не увеличена версия
+    await Ingredient.filter(id=ingredient["id"]).update(calories_per_100g=500)
+
+    response = await user_client.get(f"/api/v1/ingredients/{ingredient['id']}")
+    assert response.status_code == 200
+    assert response.json()["calories_per_100g"] == 42
+
+    await catalog.refresh()
+    assert catalog.get(ingredient["id"])["calories_per_100g"] == 42
+
+
+@pytest.mark.asyncio
+async def test_catalog_reloads_after_version_bump(ingredient, catalog):
+    version = catalog.version
+    await Ingredient.filter(id=ingredient["id"]).update(calories_per_100g=500)
+
+    # Так ингредиенты меняет другой воркер
+    await redis_service.bump_namespace(CATALOG_NAMESPACE)
+    await catalog.refresh()
+
+    assert catalog.version > version
+    assert catalog.get(ingredient["id"])["calories_per_100g"] == 500
+
+
+@pytest.mark.asyncio
+async def test_writer_sees_its_own_update(admin_client, user_client, ingredient, catalog):
+    version = catalog.version
+    response = await admin_client.put(
+        f"/api/v1/ingredients/{ingredient['id']}",
+        json={**ingredient, "calories_per_100g": 64},
+    )
+    assert response.status_code == 200
+
+    # Снимок перечитан сразу, без ожидания фонового цикла
+    assert catalog.version > version
+    response = await user_client.get(f"/api/v1/ingredients/{ingredient['id']}")
+    assert response.json()["calories_per_100g"] == 64
+
+    response = await admin_client.delete(f"/api/v1/ingredients/{ingredient['id']}")
+    assert response.status_code == 204
+    assert catalog.get(ingredient["id"]) is None
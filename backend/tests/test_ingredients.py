@@ -89,3 +89,94 @@ async def test_substitute_logic(admin_client, user_client, category_id):
     subs = get_sub_res.json()
     assert len(subs) >= 1
     assert subs[0]["substitute_ingredient_id"] == ing2_id
+
+    all_res = await user_client.get("/api/v1/ingredients/substitutes/all?size=1")
+    assert all_res.status_code == 200
+    page = all_res.json()
+    assert len(page["data"]) == 1
+    assert "original_name" in page["data"][0]
+    assert "substitute_name" in page["data"][0]
+
+
+@pytest.mark.asyncio
+async def test_get_ingredients_not_modified(user_client, admin_client, category_id):
+    payload = {
+        "name": "Milk",
+        "calories_per_100g": 42,
+        "protein_per_100g": 3.4,
+        "fat_per_100g": 1.0,
+        "carbs_per_100g": 5.0,
+        "category_id": category_id,
+    }
+    create_res = await admin_client.post("/api/v1/ingredients", json=payload)
+    ingredient_id = create_res.json()["id"]
+
+    response = await user_client.get("/api/v1/ingredients")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+
+    response = await user_client.get(
+        "/api/v1/ingredients", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+    await admin_client.put(
+        f"/api/v1/ingredients/{ingredient_id}",
+        json={**payload, "calories_per_100g": 64},
+    )
+    response = await user_client.get(
+        "/api/v1/ingredients", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.json()["data"][0]["calories_per_100g"] == 64
+
+    # Запись в обход сервиса тоже меняет ETag
+    from app.models.tortoise.ingredient import Ingredient
+
+    etag = response.headers["etag"]
+    await Ingredient.filter(id=ingredient_id).update(calories_per_100g=80)
+    response = await user_client.get(
+        "/api/v1/ingredients", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.json()["data"][0]["calories_per_100g"] == 80
+
+
+@pytest.mark.asyncio
+async def test_update_ingredient_reports_failed_recalculation(
+    admin_client, category_id, monkeypatch
+):
+    from app.services import ingredient_service
+
+    payload = {
+        "name": "Milk",
+        "calories_per_100g": 42,
+        "protein_per_100g": 3.4,
+        "fat_per_100g": 1.0,
+        "carbs_per_100g": 5.0,
+        "category_id": category_id,
+    }
+    create_res = await admin_client.post("/api/v1/ingredients", json=payload)
+    ingredient_id = create_res.json()["id"]
+
+    published = []
+
+    async def unavailable(task_type, data):
+        raise ConnectionError("queue is down")
+
+    async def publish(task_type, data):
+        published.append((task_type, data))
+
+    monkeypatch.setattr(ingredient_service.task_service, "publish_task", unavailable)
+    updated = {**payload, "calories_per_100g": 64}
+    response = await admin_client.put(f"/api/v1/ingredients/{ingredient_id}", json=updated)
+    assert response.status_code == 503
+
+    # КБЖУ уже сохранено, но повтор всё равно ставит пересчёт в очередь
+    monkeypatch.setattr(ingredient_service.task_service, "publish_task", publish)
+    response = await admin_client.put(f"/api/v1/ingredients/{ingredient_id}", json=updated)
+    assert response.status_code == 200
+    assert published == [("recalculate_nutrition", {"ingredient_id": ingredient_id})]
+
+    response = await admin_client.put(f"/api/v1/ingredients/{ingredient_id}", json=updated)
+    assert len(published) == 1
@@ -0,0 +1,62 @@
+from app.services.local_cache import LocalCache
+
+
+def test_evicts_least_recently_used_by_items():
+    cache = LocalCache(max_items=2, max_bytes=1000, ttl=60)
+    cache.set("a", b"1", 1)
+    cache.set("b", b"2", 1)
+    assert cache.get("a") == b"1"  # "b" теперь самый старый
+
+    cache.set("c", b"3", 1)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1"
+    assert cache.get("c") == b"3"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_evicts_by_bytes():
+    cache = LocalCache(max_items=100, max_bytes=10, ttl=60)
+    cache.set("a", b"aaaa", 4)
+    cache.set("b", b"bbbb", 4)
+    cache.set("c", b"cccc", 4)
+
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] == 8
+
+    # Значение больше всего кэша не кладётся и не вытесняет остальные
+    cache.set("huge", b"x" * 11, 11)
+    assert cache.get("huge") is None
+    assert cache.get("b") == b"bbbb"
+
+
+def test_expires_by_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("app.services.local_cache.time.monotonic", lambda: now[0])
+    cache = LocalCache(max_items=10, max_bytes=100, ttl=5)
+    cache.set("a", b"1", 1)
+    cache.set("b", b"2", 1, ttl=1)
+    # TTL значения не больше TTL кэша
+    cache.set("c", b"3", 1, ttl=60)
+
+    now[0] += 2
+    assert cache.get("a") == b"1"
+    assert cache.get("b") is None
+
+    now[0] += 4
+    assert cache.get("a") is None
+    assert cache.get("c") is None
+    assert cache.stats()["expirations"] == 3
+
+
+def test_delete_by_pattern():
+    cache = LocalCache(max_items=10, max_bytes=100, ttl=60)
+    cache.set("recipes_list:v1:a", b"1", 1)
+    cache.set("recipes_list:v1:b", b"2", 1)
+    cache.set("recipe:1", b"3", 1)
+
+    cache.delete_by_pattern("recipes_list:*")
+
+    assert cache.get("recipes_list:v1:a") is None
+    assert cache.get("recipe:1") == b"3"
+    assert cache.stats()["bytes"] == 1
@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+
+from app.utils.nutrition import MACROS, apply_nutrition, calculate, macro_matrix
+
+
+def macros(calories, protein, fat, carbs):
+    return {
+        "calories_per_100g": calories,
+        "protein_per_100g": protein,
+        "fat_per_100g": fat,
+        "carbs_per_100g": carbs,
+    }
+
+
+INGREDIENTS = {
+    1: macros(350, 12, 1.5, 70),
+    2: macros(50, 1.5, 0.5, 10),
+    7: macros(402, 25, 33, 1.3),
+}
+
+
+def recipe(portions, *lines):
+    return {
+        "portions": portions,
+        "ingredients": [
+            {"ingredient_id": ingredient_id, "quantity": quantity}
+            for ingredient_id, quantity in lines
+        ],
+    }
+
+
+def scalar_nutrition(recipe_dict):
+    """Прежний построчный расчёт КБЖУ - эталон для векторного"""
+    totals = dict.fromkeys(MACROS, 0)
+    lines = []
+    for ingredient in recipe_dict["ingredients"]:
+        data = INGREDIENTS[ingredient["ingredient_id"]]
+        line = {
+            macro: (data[f"{macro}_per_100g"] / 100) * ingredient["quantity"]
+            for macro in MACROS
+        }
+        for macro in MACROS:
+            totals[macro] += line[macro]
+        lines.append(line)
+
+    portions = recipe_dict["portions"]
+    result = {f"total_{macro}": round(totals[macro], 2) for macro in MACROS}
+    result.update(
+        {f"{macro}_per_portion": round(totals[macro] / portions, 2) for macro in MACROS}
+    )
+    return lines, result
+
+
+def nutrition_fields(recipe_dict):
+    return {
+        key: value
+        for key, value in recipe_dict.items()
+        if key.startswith("total_") or key.endswith("_per_portion")
+    }
+
+
+def test_matches_scalar_calculation():
+    pasta = recipe(3, (1, 200), (2, 33.3), (7, 17))
+    expected_lines, expected = scalar_nutrition(pasta)
+
+    apply_nutrition([pasta], INGREDIENTS)
+
+    assert nutrition_fields(pasta) == expected
+    for line, expected_line in zip(pasta["ingredients"], expected_lines):
+        for macro in MACROS:
+            assert line[macro] == round(expected_line[macro], 2)
+
+
+def test_batch_equals_single():
+    recipes = [
+        recipe(2, (1, 100), (2, 50)),
+        recipe(1, (7, 30), (1, 80), (2, 120)),
+        recipe(4, (2, 10), (7, 10)),
+    ]
+    singles = [
+        recipe(r["portions"], *[(i["ingredient_id"], i["quantity"]) for i in r["ingredients"]])
+        for r in recipes
+    ]
+
+    apply_nutrition(recipes, INGREDIENTS)
+    for single in singles:
+        apply_nutrition([single], INGREDIENTS)
+
+    assert recipes == singles
+
+
+def test_rounding_and_portions():
+    # 33.3 г по 50 ккал = 16.65 ккал; на 3 порции - 5.55
+    sauce = recipe(3, (2, 33.3), (2, 0))
+    apply_nutrition([sauce], INGREDIENTS)
+
+    assert sauce["ingredients"][0]["calories"] == 16.65
+    assert sauce["total_calories"] == 16.65
+    assert sauce["calories_per_portion"] == 5.55
+    assert sauce["ingredients"][1]["calories"] == 0
+
+
+def test_missing_ingredient_raises():
+    with pytest.raises(KeyError, match=r"\[3\]"):
+        apply_nutrition([recipe(1, (1, 100), (3, 100))], INGREDIENTS)
+
+    with pytest.raises(KeyError):
+        apply_nutrition([recipe(1, (1, 100), (2, 100))], {})
+
+
+def test_zero_portions_raise():
+    with pytest.raises(ValueError):
+        apply_nutrition([recipe(2, (1, 100)), recipe(0, (2, 100))], INGREDIENTS)
+
+    recipes = [recipe(0, (1, 100))]
+    with pytest.raises(ValueError):
+        apply_nutrition(recipes, INGREDIENTS)
+    assert "total_calories" not in recipes[0]
+
+
+def test_calculate_returns_unrounded_arrays():
+    ids, matrix = macro_matrix(INGREDIENTS)
+    assert ids.tolist() == [1, 2, 7]
+    assert matrix.shape == (3, len(MACROS))
+
+    lines, totals, per_portion = calculate(
+        np.array([7, 1, 2]),
+        np.array([10.0, 100.0, 100.0]),
+        np.array([0, 1, 1]),
+        np.array([1.0, 3.0]),
+        ids,
+        matrix,
+    )
+    assert lines[0].tolist() == pytest.approx([40.2, 2.5, 3.3, 0.13])
+    assert totals[1].tolist() == pytest.approx([400, 13.5, 2, 80])
+    assert per_portion[1].tolist() == pytest.approx([400 / 3, 4.5, 2 / 3, 80 / 3])
+    assert apply_nutrition([], INGREDIENTS) is None
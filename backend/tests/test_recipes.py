@@ -1,3 +1,6 @@
+import gzip
+import json
+
 import pytest
 
 
@@ -84,3 +87,788 @@ async def test_get_recipes_list(user_client, admin_client, setup_recipe_data):
     res_data = response.json()
     assert "data" in res_data
     assert len(res_data["data"]) >= 1
+
+    summary = res_data["data"][0]
+    assert "calories_per_portion" in summary
+    assert "ingredients" not in summary
+    assert "instructions" not in summary
+
+    response = await user_client.get("/api/v1/recipes?fields=name,ingredients")
+    assert response.status_code == 200
+    assert set(response.json()["data"][0]) == {"id", "name", "ingredients"}
+
+    response = await user_client.get("/api/v1/recipes?fields=name,unknown")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_filter_recipes_by_ingredients(user_client, admin_client, setup_recipe_data):
+    data = setup_recipe_data
+    oil_res = await admin_client.post(
+        "/api/v1/ingredients",
+        json={
+            "name": "Olive Oil",
+            "calories_per_100g": 884,
+            "protein_per_100g": 0,
+            "fat_per_100g": 100,
+            "carbs_per_100g": 0,
+            "category_id": data["category_id"],
+        },
+    )
+    payload = {
+        "name": "Plain Pasta",
+        "description": "Test",
+        "category_id": data["category_id"],
+        "cook_time_minutes": 10,
+        "portions": 1,
+        "ingredients": [
+            {"ingredient_id": data["ing1_id"], "quantity": 100},
+            {"ingredient_id": oil_res.json()["id"], "quantity": 10},
+        ],
+        "instructions": [{"step": 1, "description": "Boil"}],
+    }
+    create_res = await admin_client.post("/api/v1/recipes", json=payload)
+    recipe_id = create_res.json()["id"]
+
+    def ids(response):
+        return {recipe["id"] for recipe in response.json()["data"]}
+
+    response = await user_client.get(
+        f"/api/v1/recipes?exclude_ingredients={data['ing1_id']}"
+    )
+    assert response.status_code == 200
+    assert recipe_id not in ids(response)
+
+    response = await user_client.get(
+        f"/api/v1/recipes?exclude_ingredients={data['ing2_id']}"
+    )
+    assert recipe_id in ids(response)
+
+    response = await user_client.get(
+        f"/api/v1/recipes?include_ingredients={data['ing1_id']},{data['ing2_id']}"
+    )
+    assert recipe_id not in ids(response)
+
+    response = await user_client.get(
+        f"/api/v1/recipes?include_ingredients={data['ing1_id']},{data['ing2_id']}"
+        "&include_mode=any"
+    )
+    assert recipe_id in ids(response)
+
+
+@pytest.mark.asyncio
+async def test_match_pantry(user_client, admin_client, setup_recipe_data):
+    data = setup_recipe_data
+    payload = {
+        "name": "Pasta with Sauce",
+        "description": "Test",
+        "category_id": data["category_id"],
+        "cook_time_minutes": 10,
+        "portions": 1,
+        "ingredients": [
+            {"ingredient_id": data["ing1_id"], "quantity": 100},
+            {"ingredient_id": data["ing2_id"], "quantity": 50},
+        ],
+        "instructions": [{"step": 1, "description": "Mix"}],
+    }
+    create_res = await admin_client.post("/api/v1/recipes", json=payload)
+    recipe_id = create_res.json()["id"]
+
+    response = await user_client.get(
+        f"/api/v1/recipes/pantry?ingredients={data['ing1_id']}"
+    )
+    assert response.status_code == 200
+    match = next(r for r in response.json()["data"] if r["id"] == recipe_id)
+    assert match["coverage"] == 0.5
+    assert match["missing_ingredient_ids"] == [data["ing2_id"]]
+
+    response = await user_client.get(
+        f"/api/v1/recipes/pantry?ingredients={data['ing1_id']}&min_coverage=1"
+    )
+    assert recipe_id not in {r["id"] for r in response.json()["data"]}
+
+    # Соус можно заменить пастой - с заменами рецепт покрыт полностью
+    await admin_client.post(
+        "/api/v1/ingredients/substitutes",
+        json={
+            "original_ingredient_id": data["ing2_id"],
+            "substitute_ingredient_id": data["ing1_id"],
+            "coefficient": 1.0,
+        },
+    )
+    response = await user_client.get(
+        f"/api/v1/recipes/pantry?ingredients={data['ing1_id']}&use_substitutes=true"
+    )
+    match = next(r for r in response.json()["data"] if r["id"] == recipe_id)
+    assert match["coverage"] == 1
+
+    response = await user_client.get("/api/v1/recipes/pantry?ingredients=")
+    assert response.status_code == 400
+
+    await admin_client.delete(f"/api/v1/recipes/{recipe_id}")
+    response = await user_client.get(
+        f"/api/v1/recipes/pantry?ingredients={data['ing1_id']}"
+    )
+    assert recipe_id not in {r["id"] for r in response.json()["data"]}
+
+
+@pytest.mark.asyncio
+async def test_recipe_with_substitutes(user_client, admin_client, setup_recipe_data):
+    data = setup_recipe_data
+    sub_res = await admin_client.post(
+        "/api/v1/ingredients",
+        json={
+            "name": "Rice Noodles",
+            "calories_per_100g": 360,
+            "protein_per_100g": 6,
+            "fat_per_100g": 1,
+            "carbs_per_100g": 80,
+            "category_id": data["category_id"],
+        },
+    )
+    sub_id = sub_res.json()["id"]
+    link_res = await admin_client.post(
+        "/api/v1/ingredients/substitutes",
+        json={
+            "original_ingredient_id": data["ing1_id"],
+            "substitute_ingredient_id": sub_id,
+            "coefficient": 0.5,
+        },
+    )
+
+    payload = {
+        "name": "Pasta to Swap",
+        "description": "Test",
+        "category_id": data["category_id"],
+        "cook_time_minutes": 10,
+        "portions": 1,
+        "ingredients": [
+            {"ingredient_id": data["ing1_id"], "quantity": 200},
+            {"ingredient_id": data["ing2_id"], "quantity": 100},
+        ],
+        "instructions": [{"step": 1, "description": "Mix"}],
+    }
+    create_res = await admin_client.post("/api/v1/recipes", json=payload)
+    recipe_id = create_res.json()["id"]
+
+    response = await user_client.post(
+        f"/api/v1/recipes/{recipe_id}/with-substitutes",
+        json=[{"ingredient_id": data["ing1_id"]}],
+    )
+    assert response.status_code == 200
+    ingredients = {i["ingredient_id"]: i for i in response.json()["ingredients"]}
+    assert ingredients[sub_id]["quantity"] == 100
+    assert ingredients[sub_id]["calories"] == 360
+    assert response.json()["total_calories"] == 410
+
+    response = await user_client.post(
+        f"/api/v1/recipes/{recipe_id}/with-substitutes",
+        json=[{"ingredient_id": data["ing2_id"]}],
+    )
+    assert response.status_code == 404
+
+    # Удаление замены сбрасывает закэшированный результат
+    await admin_client.delete(f"/api/v1/ingredients/substitutes/{link_res.json()['id']}")
+    response = await user_client.post(
+        f"/api/v1/recipes/{recipe_id}/with-substitutes",
+        json=[{"ingredient_id": data["ing1_id"]}],
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_recipe_substitute_preference(user_client, admin_client, setup_recipe_data):
+    data = setup_recipe_data
+    candidates = {}
+    for name, calories, protein in (("Lentil Pasta", 340, 25), ("Zucchini", 17, 1)):
+        res = await admin_client.post(
+            "/api/v1/ingredients",
+            json={
+                "name": name,
+                "calories_per_100g": calories,
+                "protein_per_100g": protein,
+                "fat_per_100g": 1,
+                "carbs_per_100g": 50,
+                "category_id": data["category_id"],
+            },
+        )
+        candidates[name] = res.json()["id"]
+        await admin_client.post(
+            "/api/v1/ingredients/substitutes",
+            json={
+                "original_ingredient_id": data["ing1_id"],
+                "substitute_ingredient_id": candidates[name],
+                "coefficient": 1.0,
+            },
+        )
+
+    payload = {
+        "name": "Pasta with Options",
+        "description": "Test",
+        "category_id": data["category_id"],
+        "cook_time_minutes": 10,
+        "portions": 1,
+        "ingredients": [
+            {"ingredient_id": data["ing1_id"], "quantity": 100},
+            {"ingredient_id": data["ing2_id"], "quantity": 100},
+        ],
+        "instructions": [{"step": 1, "description": "Mix"}],
+    }
+    create_res = await admin_client.post("/api/v1/recipes", json=payload)
+    recipe_id = create_res.json()["id"]
+
+    for preference, expected in (
+        ("low_calorie", "Zucchini"),
+        ("high_protein", "Lentil Pasta"),
+    ):
+        response = await user_client.post(
+            f"/api/v1/recipes/{recipe_id}/with-substitutes?preference={preference}",
+            json=[{"ingredient_id": data["ing1_id"]}],
+        )
+        assert response.status_code == 200
+        ids = {i["ingredient_id"] for i in response.json()["ingredients"]}
+        assert candidates[expected] in ids
+
+
+@pytest.mark.asyncio
+async def test_recipe_substitute_chain(user_client, admin_client, setup_recipe_data):
+    data = setup_recipe_data
+    chain = [data["ing1_id"]]
+    for name in ("Rice", "Quinoa"):
+        res = await admin_client.post(
+            "/api/v1/ingredients",
+            json={
+                "name": name,
+                "calories_per_100g": 350,
+                "protein_per_100g": 10,
+                "fat_per_100g": 2,
+                "carbs_per_100g": 70,
+                "category_id": data["category_id"],
+            },
+        )
+        chain.append(res.json()["id"])
+    for original_id, substitute_id in zip(chain, chain[1:]):
+        await admin_client.post(
+            "/api/v1/ingredients/substitutes",
+            json={
+                "original_ingredient_id": original_id,
+                "substitute_ingredient_id": substitute_id,
+                "coefficient": 0.5,
+            },
+        )
+
+    payload = {
+        "name": "Pasta in Chain",
+        "description": "Test",
+        "category_id": data["category_id"],
+        "cook_time_minutes": 10,
+        "portions": 1,
+        "ingredients": [
+            {"ingredient_id": data["ing1_id"], "quantity": 200},
+            {"ingredient_id": data["ing2_id"], "quantity": 100},
+        ],
+        "instructions": [{"step": 1, "description": "Mix"}],
+    }
+    create_res = await admin_client.post("/api/v1/recipes", json=payload)
+    recipe_id = create_res.json()["id"]
+
+    # Pasta -> Rice недоступен, берём Rice -> Quinoa (0.5 * 0.5)
+    response = await user_client.post(
+        f"/api/v1/recipes/{recipe_id}/with-substitutes",
+        json=[{"ingredient_id": chain[0]}, {"ingredient_id": chain[1]}],
+    )
+    assert response.status_code == 200
+    ingredients = {i["ingredient_id"]: i for i in response.json()["ingredients"]}
+    assert ingredients[chain[2]]["quantity"] == 50
+
+
+@pytest.mark.asyncio
+async def test_recalculate_nutrition_after_ingredient_update(
+    user_client, admin_client, setup_recipe_data
+):
+    from app.services.recipe_service import RecipeService
+
+    data = setup_recipe_data
+    payload = {
+        "name": "Recipe to Recalculate",
+        "description": "Test",
+        "category_id": data["category_id"],
+        "cook_time_minutes": 10,
+        "portions": 2,
+        "ingredients": [
+            {"ingredient_id": data["ing1_id"], "quantity": 100},
+            {"ingredient_id": data["ing2_id"], "quantity": 100},
+        ],
+        "instructions": [{"step": 1, "description": "Cook"}],
+    }
+    create_res = await admin_client.post("/api/v1/recipes", json=payload)
+    recipe_id = create_res.json()["id"]
+    assert create_res.json()["total_calories"] == 400
+
+    await admin_client.put(
+        f"/api/v1/ingredients/{data['ing2_id']}",
+        json={
+            "name": "Tomato Sauce",
+            "calories_per_100g": 150,
+            "protein_per_100g": 1.5,
+            "fat_per_100g": 0.5,
+            "carbs_per_100g": 10,
+        },
+    )
+    # То, что делает воркер по задаче recalculate_nutrition
+    assert await RecipeService().recalculate_nutrition(data["ing2_id"]) >= 1
+
+    response = await user_client.get(f"/api/v1/recipes/{recipe_id}")
+    assert response.json()["total_calories"] == 500
+    assert response.json()["calories_per_portion"] == 250
+
+
+@pytest.mark.asyncio
+async def test_patch_recipe(user_client, admin_client, setup_recipe_data):
+    data = setup_recipe_data
+    payload = {
+        "name": "Recipe to Patch",
+        "description": "Test",
+        "category_id": data["category_id"],
+        "cook_time_minutes": 10,
+        "portions": 2,
+        "ingredients": [
+            {"ingredient_id": data["ing1_id"], "quantity": 100},
+            {"ingredient_id": data["ing2_id"], "quantity": 100},
+        ],
+        "instructions": [{"step": 1, "description": "Cook"}],
+    }
+    create_res = await admin_client.post("/api/v1/recipes", json=payload)
+    recipe_id = create_res.json()["id"]
+    # Рецепт попадает в кэш
+    await user_client.get(f"/api/v1/recipes/{recipe_id}")
+
+    response = await admin_client.patch(
+        f"/api/v1/recipes/{recipe_id}", json={"name": "Patched"}
+    )
+    assert response.status_code == 200
+    assert response.json()["name"] == "Patched"
+    assert response.json()["total_calories"] == 400
+
+    response = await admin_client.patch(
+        f"/api/v1/recipes/{recipe_id}", json={"portions": 4}
+    )
+    assert response.json()["total_calories"] == 400
+    assert response.json()["calories_per_portion"] == 100
+
+    response = await admin_client.patch(
+        f"/api/v1/recipes/{recipe_id}",
+        json={
+            "ingredients": [
+                {"ingredient_id": data["ing1_id"], "quantity": 200},
+                {"ingredient_id": data["ing2_id"], "quantity": 100},
+            ]
+        },
+    )
+    assert response.json()["total_calories"] == 750
+    ingredients = {i["ingredient_id"]: i for i in response.json()["ingredients"]}
+    assert ingredients[data["ing1_id"]]["calories"] == 700
+
+    # В кэше уже новая версия
+    response = await user_client.get(f"/api/v1/recipes/{recipe_id}")
+    assert response.json()["name"] == "Patched"
+    assert response.json()["calories_per_portion"] == 187.5
+
+    response = await admin_client.patch(
+        "/api/v1/recipes/000000000000000000000000", json={"name": "Missing"}
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_import_recipes_ndjson(user_client, admin_client, setup_recipe_data):
+    data = setup_recipe_data
+
+    def recipe(name, ingredient_ids):
+        return {
+            "name": name,
+            "description": "Imported",
+            "category_id": data["category_id"],
+            "cook_time_minutes": 15,
+            "portions": 2,
+            "ingredients": [
+                {"ingredient_id": ingredient_id, "quantity": 100}
+                for ingredient_id in ingredient_ids
+            ],
+            "instructions": [{"step": 1, "description": "Cook"}],
+        }
+
+    lines = [
+        json.dumps(recipe("Imported 1", [data["ing1_id"], data["ing2_id"]])),
+        "{not json",
+        json.dumps(recipe("Imported 2", [data["ing1_id"], 999999])),
+        json.dumps({"name": "No fields"}),
+        json.dumps(recipe("Imported 3", [data["ing2_id"], data["ing1_id"]])),
+    ]
+    response = await admin_client.post(
+        "/api/v1/recipes/import", content="\n".join(lines).encode()
+    )
+    assert response.status_code == 200
+    report = response.json()
+    assert report["inserted"] == 2
+    assert report["failed"] == 3
+    assert [error["line"] for error in report["errors"]] == [2, 4, 3]
+
+    response = await user_client.get("/api/v1/recipes?fields=name,total_calories")
+    imported = {r["name"]: r for r in response.json()["data"]}
+    assert imported["Imported 1"]["total_calories"] == 400
+    assert "Imported 3" in imported
+
+    response = await user_client.post("/api/v1/recipes/import", content=lines[0])
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_export_recipes_ndjson(user_client, admin_client, setup_recipe_data):
+    data = setup_recipe_data
+    for name, cook_time in [("Quick", 10), ("Slow", 90)]:
+        await admin_client.post(
+            "/api/v1/recipes",
+            json={
+                "name": name,
+                "description": "Test",
+                "category_id": data["category_id"],
+                "cook_time_minutes": cook_time,
+                "portions": 1,
+                "ingredients": [
+                    {"ingredient_id": data["ing1_id"], "quantity": 100},
+                    {"ingredient_id": data["ing2_id"], "quantity": 50},
+                ],
+                "instructions": [{"step": 1, "description": "Cook"}],
+            },
+        )
+
+    response = await admin_client.get("/api/v1/recipes/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    recipes = [json.loads(line) for line in response.text.splitlines()]
+    assert {recipe["name"] for recipe in recipes} == {"Quick", "Slow"}
+    assert all("id" in recipe and "ingredients" in recipe for recipe in recipes)
+
+    response = await admin_client.get("/api/v1/recipes/export?max_time=30&gzip=true")
+    assert response.headers["content-type"] == "application/gzip"
+    lines = gzip.decompress(response.content).splitlines()
+    assert [json.loads(line)["name"] for line in lines] == ["Quick"]
+
+    response = await user_client.get("/api/v1/recipes/export")
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_get_recipes_batch(user_client, admin_client, setup_recipe_data):
+    data = setup_recipe_data
+    recipe_ids = []
+    for name in ["First", "Second", "Third"]:
+        response = await admin_client.post(
+            "/api/v1/recipes",
+            json={
+                "name": name,
+                "description": "Test",
+                "category_id": data["category_id"],
+                "cook_time_minutes": 10,
+                "portions": 1,
+                "ingredients": [
+                    {"ingredient_id": data["ing1_id"], "quantity": 100},
+                    {"ingredient_id": data["ing2_id"], "quantity": 50},
+                ],
+                "instructions": [{"step": 1, "description": "Cook"}],
+            },
+        )
+        recipe_ids.append(response.json()["id"])
+
+    missing_id = "000000000000000000000000"
+    response = await user_client.post(
+        "/api/v1/recipes/batch",
+        json={"ids": [recipe_ids[2], missing_id, recipe_ids[0], "invalid"]},
+    )
+    assert response.status_code == 200
+    assert [r["name"] for r in response.json()["data"]] == ["Third", "First"]
+    assert response.json()["not_found"] == [missing_id, "invalid"]
+
+    single = await user_client.get(f"/api/v1/recipes/{recipe_ids[2]}")
+    assert response.json()["data"][0] == single.json()
+
+    response = await user_client.post("/api/v1/recipes/batch", json={"ids": ["x"] * 101})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_create_recipe_reports_all_missing_ingredients(
+    admin_client, setup_recipe_data
+):
+    data = setup_recipe_data
+    payload = {
+        "name": "Broken Recipe",
+        "description": "Unknown ingredients",
+        "category_id": data["category_id"],
+        "cook_time_minutes": 10,
+        "portions": 1,
+        "ingredients": [
+            {"ingredient_id": data["ing1_id"], "quantity": 100},
+            {"ingredient_id": 999998, "quantity": 50},
+            {"ingredient_id": 999999, "quantity": 50},
+        ],
+        "instructions": [{"step": 1, "description": "Eat"}],
+    }
+    response = await admin_client.post("/api/v1/recipes", json=payload)
+    assert response.status_code == 400
+    detail = response.json()["detail"]
+    assert "999998" in detail
+    assert "999999" in detail
+
+
+@pytest.mark.asyncio
+async def test_recipe_rejects_zero_portions(admin_client, setup_recipe_data):
+    data = setup_recipe_data
+    payload = {
+        "name": "Zero Portions",
+        "description": "Test",
+        "category_id": data["category_id"],
+        "cook_time_minutes": 10,
+        "portions": 0,
+        "ingredients": [
+            {"ingredient_id": data["ing1_id"], "quantity": 100},
+            {"ingredient_id": data["ing2_id"], "quantity": 50},
+        ],
+        "instructions": [{"step": 1, "description": "Eat"}],
+    }
+    response = await admin_client.post("/api/v1/recipes", json=payload)
+    assert response.status_code == 422
+
+    create_res = await admin_client.post(
+        "/api/v1/recipes", json={**payload, "portions": 2}
+    )
+    recipe_id = create_res.json()["id"]
+
+    response = await admin_client.put(f"/api/v1/recipes/{recipe_id}", json=payload)
+    assert response.status_code == 422
+
+    response = await admin_client.patch(
+        f"/api/v1/recipes/{recipe_id}", json={"portions": 0}
+    )
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_get_recipe_not_modified(user_client, admin_client, setup_recipe_data):
+    data = setup_recipe_data
+    payload = {
+        "name": "Recipe with ETag",
+        "description": "Test",
+        "category_id": data["category_id"],
+        "cook_time_minutes": 10,
+        "portions": 1,
+        "ingredients": [
+            {"ingredient_id": data["ing1_id"], "quantity": 100},
+            {"ingredient_id": data["ing2_id"], "quantity": 50},
+        ],
+        "instructions": [{"step": 1, "description": "Eat"}],
+    }
+    create_res = await admin_client.post("/api/v1/recipes", json=payload)
+    recipe_id = create_res.json()["id"]
+
+    response = await user_client.get(f"/api/v1/recipes/{recipe_id}")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+
+    response = await user_client.get(
+        f"/api/v1/recipes/{recipe_id}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+
+
+def _scanned_indexes(plan) -> set:
+    """Имена индексов во всех стадиях IXSCAN плана"""
+    if isinstance(plan, list):
+        return set().union(*map(_scanned_indexes, plan)) if plan else set()
+    if not isinstance(plan, dict):
+        return set()
+    names = {plan["indexName"]} if plan.get("stage") == "IXSCAN" else set()
+    for value in plan.values():
+        names |= _scanned_indexes(value)
+    return names
+
+
+@pytest.mark.asyncio
+async def test_recipe_list_queries_use_indexes():
+    import os
+
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    from app.db.indexes import INDEXES, diff_indexes, ensure_indexes
+    from app.services.recipe_service import RecipeService
+
+    m_client = AsyncIOMotorClient(os.environ["MONGODB_URL"])
+    db = m_client[os.environ["MONGODB_DB"]]
+    await ensure_indexes(db)
+
+    diff = await diff_indexes(db)
+    assert not diff["recipes"]["missing"]
+    assert not diff["store_products"]["missing"]
+
+    base = {
+        "category_id": 99,
+        "total_calories": 5000,
+        "cook_time_minutes": 300,
+        "ingredient_ids": [3, 4],
+    }
+    # (фильтр, ожидаемый индекс, фоновые рецепты, подходящие под фильтр).
+    # Подходящих мало и они вставлены последними - по встроенному _id_
+    # до них пришлось бы дочитать всю коллекцию
+    cases = [
+        ({}, "_id_", [base], base),
+        ({"category_id": 1}, "category_id_id", [base], {**base, "category_id": 1}),
+        (
+            {"category_id": 1, "min_calories": 100, "max_calories": 500},
+            "category_id_total_calories_id",
+            [{**base, "category_id": 1}, {**base, "total_calories": 300}],
+            {**base, "category_id": 1, "total_calories": 300},
+        ),
+        (
+            {"min_calories": 100, "max_calories": 500},
+            "total_calories_id",
+            [base],
+            {**base, "total_calories": 300},
+        ),
+        ({"max_time": 30}, "cook_time_minutes_id", [base], {**base, "cook_time_minutes": 10}),
+        (
+            {"cursor": "0" * 24, "category_id": 1},
+            "category_id_id",
+            [base],
+            {**base, "category_id": 1},
+        ),
+        (
+            {"exclude_ingredients": [1, 2]},
+            "ingredient_ids_id",
+            [{**base, "ingredient_ids": [1, 2]}],
+            base,
+        ),
+        (
+            {"include_ingredients": [1, 2]},
+            "ingredient_ids_id",
+            [base],
+            {**base, "ingredient_ids": [1, 2]},
+        ),
+        (
+            {"include_ingredients": [1, 2], "include_mode": "any"},
+            "ingredient_ids_id",
+            [base],
+            {**base, "ingredient_ids": [1, 5]},
+        ),
+    ]
+    registered = {model.document["name"] for model in INDEXES["recipes"]}
+
+    for shape, expected_index, background, matching in cases:
+        assert expected_index in registered | {"_id_"}
+
+        await db.recipes.delete_many({})
+        await db.recipes.insert_many(
+            [dict(background[i % len(background)]) for i in range(300)]
+        )
+        await db.recipes.insert_many([dict(matching) for _ in range(5)])
+
+        filters = RecipeService.build_list_filters(**shape)
+        plan = await db.recipes.find(filters).sort("_id", 1).limit(31).explain()
+        used = _scanned_indexes(plan["queryPlanner"]["winningPlan"])
+        assert used == {expected_index}, (shape, used)
+
+    await db.recipes.delete_many({})
+    m_client.close()
+
+
+@pytest.mark.asyncio
+async def test_replace_recipe_without_created_at(admin_client, setup_recipe_data):
+    from bson import ObjectId
+
+    from app.db.mongodb import get_mongodb
+
+    data = setup_recipe_data
+    payload = {
+        "name": "Legacy Recipe",
+        "description": "Test",
+        "category_id": data["category_id"],
+        "cook_time_minutes": 10,
+        "portions": 2,
+        "ingredients": [
+            {"ingredient_id": data["ing1_id"], "quantity": 100},
+            {"ingredient_id": data["ing2_id"], "quantity": 100},
+        ],
+        "instructions": [{"step": 1, "description": "Cook"}],
+    }
+    create_res = await admin_client.post("/api/v1/recipes", json=payload)
+    recipe_id = create_res.json()["id"]
+
+    # Так выглядят документы, импортированные до появления created_at
+    db = await get_mongodb()
+    await db.recipes.update_one(
+        {"_id": ObjectId(recipe_id)}, {"$unset": {"created_at": ""}}
+    )
+
+    response = await admin_client.put(
+        f"/api/v1/recipes/{recipe_id}", json={**payload, "name": "Replaced"}
+    )
+    assert response.status_code == 200
+    assert response.json()["name"] == "Replaced"
+    assert response.json()["created_at"] is not None
+
+
+@pytest.mark.asyncio
+async def test_recalculate_nutrition_retries_changed_recipes(
+    user_client, admin_client, setup_recipe_data
+):
+    from bson import ObjectId
+
+    from app.db.mongodb import get_mongodb
+    from app.services.recipe_service import RecipeService
+
+    data = setup_recipe_data
+    payload = {
+        "name": "Recipe Changed During Recalculation",
+        "description": "Test",
+        "category_id": data["category_id"],
+        "cook_time_minutes": 10,
+        "portions": 2,
+        "ingredients": [
+            {"ingredient_id": data["ing1_id"], "quantity": 100},
+            {"ingredient_id": data["ing2_id"], "quantity": 100},
+        ],
+        "instructions": [{"step": 1, "description": "Cook"}],
+    }
+    renamed_id = (await admin_client.post("/api/v1/recipes", json=payload)).json()["id"]
+    changed_id = (await admin_client.post("/api/v1/recipes", json=payload)).json()["id"]
+
+    # Пачка, прочитанная воркером до изменения ингредиента и рецептов
+    db = await get_mongodb()
+    batch = await db.recipes.find(
+        {"_id": {"$in": [ObjectId(renamed_id), ObjectId(changed_id)]}},
+        {"ingredients": 1, "portions": 1},
+    ).to_list(None)
+
+    await admin_client.put(
+        f"/api/v1/ingredients/{data['ing2_id']}",
+        json={
+            "name": "Tomato Sauce",
+            "calories_per_100g": 150,
+            "protein_per_100g": 1.5,
+            "fat_per_100g": 0.5,
+            "carbs_per_100g": 10,
+        },
+    )
+    await admin_client.patch(f"/api/v1/recipes/{renamed_id}", json={"name": "Renamed"})
+    await admin_client.patch(f"/api/v1/recipes/{changed_id}", json={"portions": 4})
+
+    assert await RecipeService()._write_nutrition(batch) == 2
+
+    response = await user_client.get(f"/api/v1/recipes/{renamed_id}")
+    assert response.json()["name"] == "Renamed"
+    assert response.json()["total_calories"] == 500
+
+    response = await user_client.get(f"/api/v1/recipes/{changed_id}")
+    assert response.json()["total_calories"] == 500
+    assert response.json()["calories_per_portion"] == 125
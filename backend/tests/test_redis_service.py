@@ -0,0 +1,185 @@
+import asyncio
+
+import fakeredis
+import orjson
+import pytest
+
+from app.config import settings
+from app.services.redis_service import RedisService
+from app.utils import cache_codec
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def make_service(server) -> RedisService:
+    """Отдельный экземпляр сервиса - как в отдельном воркере"""
+    service = RedisService()
+    service._redis = fakeredis.FakeAsyncRedis(server=server)
+    return service
+
+
+@pytest.fixture
+async def cache(server):
+    service = make_service(server)
+    yield service
+    await service.stop_invalidation_listener()
+    await service._redis.aclose()
+
+
+class Loader:
+    def __init__(self, value=None, delay: float = 0.05):
+        self.value = value
+        self.delay = delay
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return self.value
+
+
+async def test_single_flight_in_process(cache):
+    loader = Loader({"name": "Pasta"})
+
+    results = await asyncio.gather(
+        *[cache.get_or_set("recipe:1", loader, expire=60) for _ in range(20)]
+    )
+
+    assert loader.calls == 1
+    assert all(result == {"name": "Pasta"} for result in results)
+    # Блокировка между воркерами снята после записи
+    assert not await cache._redis.exists("lock:recipe:1")
+
+
+async def test_single_flight_across_workers(server, cache):
+    other = make_service(server)
+    first, second = Loader({"n": 1}, delay=0.2), Loader({"n": 2})
+
+    results = await asyncio.gather(
+        cache.get_or_set("recipe:1", first, expire=60),
+        other.get_or_set("recipe:1", second, expire=60),
+    )
+
+    # Второй воркер дождался записи лидера, а не пошёл в базу сам
+    assert first.calls + second.calls == 1
+    assert results[0] == results[1]
+    await other._redis.aclose()
+
+
+async def test_lock_released_when_loader_fails(cache):
+    async def failing():
+        raise RuntimeError("mongo is down")
+
+    with pytest.raises(RuntimeError):
+        await cache.get_or_set("recipe:1", failing, expire=60)
+    assert not await cache._redis.exists("lock:recipe:1")
+
+    # Следующий запрос загружает значение заново
+    loader = Loader({"name": "Pasta"}, delay=0)
+    assert await cache.get_or_set("recipe:1", loader, expire=60) == {"name": "Pasta"}
+    assert loader.calls == 1
+
+
+async def test_missing_value_is_not_cached(cache):
+    loader = Loader(None, delay=0)
+
+    assert await cache.get_or_set("recipe:1", loader, expire=60) is None
+    assert await cache.get_or_set("recipe:1", loader, expire=60) is None
+    assert loader.calls == 2
+    assert not await cache._redis.exists("recipe:1")
+
+
+async def test_stale_value_served_and_refreshed(cache):
+    await cache.get_or_set("recipe:1", Loader("old", delay=0), expire=60, stale_ttl=30)
+    # До конца жизни ключа меньше stale_ttl - значение устарело
+    await cache._redis.pexpire("recipe:1", 10_000)
+    cache._local.clear()
+
+    loader = Loader("new", delay=0.05)
+    value = await cache.get_or_set("recipe:1", loader, expire=60, stale_ttl=30)
+    assert value == "old"
+
+    await asyncio.sleep(0.2)
+    assert loader.calls == 1
+    assert await cache.get("recipe:1") == "new"
+    assert await cache._redis.ttl("recipe:1") > 60
+    assert not await cache._redis.exists("lock:recipe:1")
+
+
+async def test_failed_refresh_keeps_stale_value(cache, caplog):
+    await cache.get_or_set("recipe:1", Loader("old", delay=0), expire=60, stale_ttl=30)
+    await cache._redis.pexpire("recipe:1", 10_000)
+    cache._local.clear()
+
+    async def failing():
+        raise RuntimeError("mongo is down")
+
+    assert await cache.get_or_set("recipe:1", failing, expire=60, stale_ttl=30) == "old"
+    await asyncio.sleep(0.05)
+
+    assert "Cache refresh failed for recipe:1" in caplog.text
+    assert await cache._redis.get("lock:recipe:1") is None
+    cache._local.clear()
+    assert await cache.get("recipe:1") == "old"
+
+
+async def test_invalidation_listener_reconnects(cache, monkeypatch, caplog):
+    monkeypatch.setattr("app.services.redis_service.LISTENER_RETRY_SECONDS", 0.01)
+    real_pubsub = cache._redis.pubsub
+    attempts = []
+
+    def flaky_pubsub():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ConnectionError("redis restarted")
+        return real_pubsub()
+
+    monkeypatch.setattr(cache._redis, "pubsub", flaky_pubsub)
+    await cache.start_invalidation_listener()
+    await asyncio.sleep(0.1)
+
+    assert len(attempts) == 2
+    assert not cache._listener_task.done()
+    assert "reconnecting" in caplog.text
+
+
+async def test_l1_invalidated_across_workers(server, cache):
+    other = make_service(server)
+    await cache.start_invalidation_listener()
+    await asyncio.sleep(0.05)
+
+    await other.set("recipe:1", "old", expire=60)
+    assert await cache.get("recipe:1") == "old"
+    # Второе чтение - из L1, без обращения к Redis
+    redis_hits = cache.get_stats()["redis"]["hits"]
+    assert await cache.get("recipe:1") == "old"
+    assert cache.get_stats()["redis"]["hits"] == redis_hits
+
+    await other.delete("recipe:1")
+    await asyncio.sleep(0.05)
+
+    assert await cache.get("recipe:1") is None
+    await other._redis.aclose()
+
+
+async def test_raw_bytes_served_without_decoding(cache, monkeypatch):
+    monkeypatch.setattr(settings, "CACHE_CODEC", "json")
+    monkeypatch.setattr(settings, "CACHE_COMPRESS_THRESHOLD", 0)
+    value = {"id": "1", "name": "Pasta", "total_calories": 400.0}
+
+    data = await cache.get_or_set_raw("recipe:1", Loader(value, delay=0), expire=60)
+    # В Redis лежат ровно те байты, что вернул сервис
+    assert await cache._redis.get("recipe:1") == data
+
+    decoded = []
+    monkeypatch.setattr(
+        "app.utils.cache_codec.decode", lambda raw: decoded.append(raw)
+    )
+    body = cache_codec.to_json(await cache.get_raw("recipe:1"))
+    assert orjson.loads(body) == value
+    assert not decoded
+    # Повторное чтение из L1 отдаёт тот же объект без копирования
+    assert await cache.get_raw("recipe:1") is await cache.get_raw("recipe:1")
@@ -0,0 +1,129 @@
+from types import MappingProxyType
+
+import numpy as np
+import pytest
+
+from app.services import substitute_index as substitute_index_module
+from app.services.ingredient_catalog import IngredientCatalog
+from app.services.substitute_index import SUBSTITUTE_PREFERENCES, SubstituteIndex
+
+INGREDIENT_COUNT = 40
+ROW_COUNT = 200
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    catalog = IngredientCatalog()
+    monkeypatch.setattr(substitute_index_module, "ingredient_catalog", catalog)
+    return catalog
+
+
+def set_snapshot(catalog, macros, version):
+    catalog._snapshot = MappingProxyType(
+        {
+            ingredient_id: MappingProxyType(
+                {
+                    "id": ingredient_id,
+                    "calories_per_100g": row[0],
+                    "protein_per_100g": row[1],
+                    "fat_per_100g": row[2],
+                    "carbs_per_100g": row[3],
+                }
+            )
+            for ingredient_id, row in macros.items()
+        }
+    )
+    catalog._version = version
+    catalog._loaded = True
+
+
+def make_index(rng):
+    index = SubstituteIndex()
+    index._rows = {
+        "id": np.arange(1, ROW_COUNT + 1),
+        "original": rng.integers(1, INGREDIENT_COUNT + 1, ROW_COUNT),
+        "substitute": rng.integers(1, INGREDIENT_COUNT + 1, ROW_COUNT),
+        "coefficient": rng.uniform(0.5, 2, ROW_COUNT),
+    }
+    index._macro_ids, index._macros = index._catalog_macros()
+    index._rank()
+    return index
+
+
+def assert_same_ranking(index):
+    """Инкрементальный пересчёт должен совпадать с полным"""
+    reference = SubstituteIndex()
+    reference._rows = index._rows
+    reference._macro_ids, reference._macros = reference._catalog_macros()
+    reference._rank()
+
+    assert index._spans == reference._spans
+    for preference in SUBSTITUTE_PREFERENCES:
+        assert np.array_equal(index._orders[preference], reference._orders[preference])
+
+
+def random_macros(rng, ingredient_ids):
+    return {
+        ingredient_id: rng.uniform(0, 100, 4).tolist() for ingredient_id in ingredient_ids
+    }
+
+
+def test_update_macros_reranks_changed_ingredients(catalog):
+    rng = np.random.default_rng(7)
+    macros = random_macros(rng, range(1, INGREDIENT_COUNT + 1))
+    set_snapshot(catalog, macros, 1)
+    index = make_index(rng)
+
+    for version in range(2, 12):
+        changed = rng.choice(INGREDIENT_COUNT, 3, replace=False) + 1
+        macros.update(random_macros(rng, changed.tolist()))
+        set_snapshot(catalog, macros, version)
+
+        index._update_macros()
+        assert_same_ranking(index)
+
+
+def test_update_macros_without_changes(catalog):
+    rng = np.random.default_rng(7)
+    macros = random_macros(rng, range(1, INGREDIENT_COUNT + 1))
+    set_snapshot(catalog, macros, 1)
+    index = make_index(rng)
+
+    set_snapshot(catalog, macros, 2)
+    assert index._update_macros() is False
+
+
+def test_update_macros_after_ingredient_removed(catalog):
+    rng = np.random.default_rng(7)
+    macros = random_macros(rng, range(1, INGREDIENT_COUNT + 1))
+    set_snapshot(catalog, macros, 1)
+    index = make_index(rng)
+
+    del macros[1]
+    set_snapshot(catalog, macros, 2)
+
+    assert index._update_macros() is True
+    assert 1 not in index._spans
+    assert_same_ranking(index)
+
+
+async def test_sync_skips_lock_when_versions_match(catalog, monkeypatch):
+    index = SubstituteIndex()
+    index._versions = (3, 5)
+    index._loaded = True
+
+    async def fetch_versions():
+        return (3, 5)
+
+    async def fail():
+        raise AssertionError("rows must not be reloaded")
+
+    monkeypatch.setattr(index, "_fetch_versions", fetch_versions)
+    monkeypatch.setattr(index, "_load_rows", fail)
+
+    await index._lock.acquire()
+    try:
+        # Блокировка занята - быстрый путь не должен её ждать
+        await index.sync()
+    finally:
+        index._lock.release()
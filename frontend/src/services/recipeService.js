@@ -318,12 +318,22 @@ const recipeService = {
   },
 
   /**
-   * Получить все замены ингредиентов
+   * Получить все замены ингредиентов (собирает все страницы)
+   *
+   * @returns {Promise} - массив замен
    */
   async getAllSubstitutes() {
     try {
-      const { data } = await api.get("/ingredients/substitutes/all");
-      return data;
+      const substitutes = [];
+      let cursor = null;
+      do {
+        const { data } = await api.get("/ingredients/substitutes/all", {
+          params: { size: 200, cursor },
+        });
+        substitutes.push(...data.data);
+        cursor = data.has_more ? data.next_cursor : null;
+      } while (cursor);
+      return substitutes;
     } catch (error) {
       console.error("Error fetching all substitutes:", error);
       throw error;